@@ -104,6 +104,10 @@ class CouplingBlock(nn.Module):
 
 
 class MultiHeadAttention(nn.Module):
+  # with window_size, add the relative terms on the 2 * window_size + 1 diagonals they cover
+  # instead of going through [b, h, l, 2l-1] padded relative tensors (same outputs)
+  relative_band = True
+
   def __init__(self, channels, out_channels, n_heads, window_size=None, heads_share=True, p_dropout=0., block_length=None, proximal_bias=False, proximal_init=False):
     super().__init__()
     assert channels % n_heads == 0
@@ -157,11 +161,16 @@ class MultiHeadAttention(nn.Module):
     scores = torch.matmul(query, key.transpose(-2, -1)) / math.sqrt(self.k_channels)
     if self.window_size is not None:
       assert t_s == t_t, "Relative attention is only available for self-attention."
-      key_relative_embeddings = self._get_relative_embeddings(self.emb_rel_k, t_s)
-      rel_logits = self._matmul_with_relative_keys(query, key_relative_embeddings)
-      rel_logits = self._relative_position_to_absolute_position(rel_logits)
-      scores_local = rel_logits / math.sqrt(self.k_channels)
-      scores = scores + scores_local
+      if self.relative_band:
+        key_relative_embeddings = self._get_relative_band_embeddings(self.emb_rel_k, t_s)
+        rel_logits = self._matmul_with_relative_keys(query, key_relative_embeddings)
+        scores = self._add_relative_band(scores, rel_logits / math.sqrt(self.k_channels))
+      else:
+        key_relative_embeddings = self._get_relative_embeddings(self.emb_rel_k, t_s)
+        rel_logits = self._matmul_with_relative_keys(query, key_relative_embeddings)
+        rel_logits = self._relative_position_to_absolute_position(rel_logits)
+        scores_local = rel_logits / math.sqrt(self.k_channels)
+        scores = scores + scores_local
     if self.proximal_bias:
       assert t_s == t_t, "Proximal bias is only available for self-attention."
       scores = scores + self._attention_bias_proximal(t_s).to(device=scores.device, dtype=scores.dtype)
@@ -174,8 +183,12 @@ class MultiHeadAttention(nn.Module):
     p_attn = self.drop(p_attn)
     output = torch.matmul(p_attn, value)
     if self.window_size is not None:
-      relative_weights = self._absolute_position_to_relative_position(p_attn)
-      value_relative_embeddings = self._get_relative_embeddings(self.emb_rel_v, t_s)
+      if self.relative_band:
+        relative_weights = self._relative_band(p_attn)
+        value_relative_embeddings = self._get_relative_band_embeddings(self.emb_rel_v, t_s)
+      else:
+        relative_weights = self._absolute_position_to_relative_position(p_attn)
+        value_relative_embeddings = self._get_relative_embeddings(self.emb_rel_v, t_s)
       output = output + self._matmul_with_relative_values(relative_weights, value_relative_embeddings)
     output = output.transpose(2, 3).contiguous().view(b, d, t_t) # [b, n_h, t_t, d_k] -> [b, d, t_t]
     return output, p_attn
@@ -244,6 +257,36 @@ class MultiHeadAttention(nn.Module):
     x_final = x_flat.view([batch, heads, length, 2*length])[:,:,:,1:]
     return x_final
 
+  def _band_offsets(self, length):
+    """ Relative positions j - i within the window that occur in a sequence of `length` """
+    n = min(self.window_size, length - 1)
+    return range(-n, n + 1)
+
+  def _get_relative_band_embeddings(self, relative_embeddings, length):
+    """ Embeddings of _band_offsets(length): [h or 1, 2*n+1, d] """
+    n = min(self.window_size, length - 1)
+    return relative_embeddings[:, self.window_size - n:self.window_size + n + 1]
+
+  def _add_relative_band(self, x, band):
+    """
+    x: [b, h, l, l], updated in place
+    band: [b, h, l, 2*n+1], band[..., i, r] is added to x[..., i, i + _band_offsets(l)[r]]
+    """
+    length = x.size(-1)
+    for r, offset in enumerate(self._band_offsets(length)):
+      rows = slice(max(-offset, 0), length - max(offset, 0))
+      x.diagonal(offset, -2, -1).add_(band[:, :, rows, r])
+    return x
+
+  def _relative_band(self, x):
+    """
+    x: [b, h, l, l]
+    ret: [b, h, l, 2*n+1], ret[..., i, r] = x[..., i, i + _band_offsets(l)[r]] (0 outside x)
+    """
+    length = x.size(-1)
+    return torch.stack([F.pad(x.diagonal(offset, -2, -1), [max(-offset, 0), max(offset, 0)])
+        for offset in self._band_offsets(length)], -1)
+
   def _attention_bias_proximal(self, length):
     """Bias for self-attention to encourage attention to close positions.
     Args:
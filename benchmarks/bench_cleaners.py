@@ -0,0 +1,101 @@
+""" english_cleaners against the original sequential pipeline it replaced.
+
+  python -m benchmarks.bench_cleaners --filelist filelists/train.txt
+"""
+import argparse
+import random
+import re
+import time
+
+import inflect
+
+from utils import load_filepaths_and_text
+from text import cleaners, numbers
+
+
+_inflect = inflect.engine()
+
+
+def _reference_expand_ordinal(m):
+  return _inflect.number_to_words(m.group(0))
+
+
+def _reference_expand_number(m):
+  num = int(m.group(0))
+  if num > 1000 and num < 3000:
+    if num == 2000:
+      return 'two thousand'
+    elif num > 2000 and num < 2010:
+      return 'two thousand ' + _inflect.number_to_words(num % 100)
+    elif num % 100 == 0:
+      return _inflect.number_to_words(num // 100) + ' hundred'
+    else:
+      return _inflect.number_to_words(num, andword='', zero='oh', group=2).replace(', ', ' ')
+  else:
+    return _inflect.number_to_words(num, andword='')
+
+
+def reference_normalize_numbers(text):
+  text = re.sub(numbers._comma_number_re, numbers._remove_commas, text)
+  text = re.sub(numbers._pounds_re, r'\1 pounds', text)
+  text = re.sub(numbers._dollars_re, numbers._expand_dollars, text)
+  text = re.sub(numbers._decimal_number_re, numbers._expand_decimal_point, text)
+  text = re.sub(numbers._ordinal_re, _reference_expand_ordinal, text)
+  text = re.sub(numbers._number_re, _reference_expand_number, text)
+  return text
+
+
+def reference_english_cleaners(text):
+  text = cleaners.convert_to_ascii(text)
+  text = cleaners.lowercase(text)
+  text = reference_normalize_numbers(text)
+  text = cleaners.expand_abbreviations(text)
+  text = re.sub(cleaners._whitespace_re, ' ', text)
+  return text
+
+
+def adversarial_texts(n, seed=1234):
+  """Runs of abbreviations glued together, mixed case and numbers."""
+  rng = random.Random(seed)
+  abbreviations = [x[0] for x in cleaners._abbreviation_list]
+  pieces = abbreviations + [a.upper() for a in abbreviations] + [
+    '.', ' ', '..', 'x', 'a.', '1st', '2,000', '$3.50', '1984', '-', "'"]
+  texts = []
+  for _ in range(n):
+    text = ''
+    for _ in range(rng.randint(1, 12)):
+      piece = rng.choice(pieces)
+      text += piece + ('.' if piece in abbreviations and rng.random() < 0.8 else '')
+    texts.append(text)
+  return texts
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--filelist', type=str, default="filelists/train.txt")
+  parser.add_argument('--n_adversarial', type=int, default=100000)
+  args = parser.parse_args()
+
+  texts = [x[-1] for x in load_filepaths_and_text(args.filelist)]
+
+  for name, inputs in [("filelist", texts), ("adversarial", adversarial_texts(args.n_adversarial))]:
+    mismatches = [t for t in inputs if cleaners.english_cleaners(t) != reference_english_cleaners(t)]
+    print("{}: {} texts, {} mismatches".format(name, len(inputs), len(mismatches)))
+    for t in mismatches[:5]:
+      print("  {!r}: {!r} != {!r}".format(t, cleaners.english_cleaners(t), reference_english_cleaners(t)))
+    assert not mismatches
+
+  # cold: first pass over the filelist, warm: later epochs
+  numbers._number_to_words.cache_clear()
+  numbers._ordinal_to_words.cache_clear()
+  for name, fn in [("reference", reference_english_cleaners), ("cold", cleaners.english_cleaners),
+                   ("warm", cleaners.english_cleaners)]:
+    start = time.perf_counter()
+    for t in texts:
+      fn(t)
+    elapsed = time.perf_counter() - start
+    print("{:>9}: {:7.1f} ms, {:7.0f} texts/s".format(name, elapsed * 1e3, len(texts) / elapsed))
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,73 @@
+""" PaddedBatchPacker against the padding TextMelCollate did before (fresh zeroed tensors per batch).
+
+  python -m benchmarks.bench_collate --batch_sizes 32 64 128 256
+"""
+import argparse
+import torch
+
+from data_utils import PaddedBatchPacker
+from benchmarks.timing import timeit
+
+
+def reference_collate(batch, n_frames_per_step=1):
+  input_lengths, ids_sorted_decreasing = torch.sort(
+      torch.LongTensor([len(x[0]) for x in batch]),
+      dim=0, descending=True)
+  max_input_len = input_lengths[0]
+
+  text_padded = torch.LongTensor(len(batch), max_input_len)
+  text_padded.zero_()
+  for i in range(len(ids_sorted_decreasing)):
+    text = batch[ids_sorted_decreasing[i]][0]
+    text_padded[i, :text.size(0)] = text
+
+  max_target_len = max([x[1].size(1) for x in batch])
+  if max_target_len % n_frames_per_step != 0:
+    max_target_len += n_frames_per_step - max_target_len % n_frames_per_step
+
+  num_mels = batch[0][1].size(0)
+  mel_padded = torch.FloatTensor(len(batch), num_mels, max_target_len)
+  mel_padded.zero_()
+  output_lengths = torch.LongTensor(len(batch))
+  for i in range(len(ids_sorted_decreasing)):
+    mel = batch[ids_sorted_decreasing[i]][1]
+    mel_padded[i, :, :mel.size(1)] = mel
+    output_lengths[i] = mel.size(1)
+  return text_padded, input_lengths, mel_padded, output_lengths
+
+
+def random_batch(batch_size, n_mel_channels=80, generator=None):
+  batch = []
+  for _ in range(batch_size):
+    text_len = int(torch.randint(20, 200, (1,), generator=generator))
+    mel_len = int(torch.randint(100, 900, (1,), generator=generator))
+    batch.append((torch.randint(1, 148, (text_len,), generator=generator, dtype=torch.int32),
+                  torch.randn(n_mel_channels, mel_len, generator=generator)))
+  return batch
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--batch_sizes', type=int, nargs='+', default=[32, 64, 128, 256])
+  parser.add_argument('--n_batches', type=int, default=10)
+  parser.add_argument('--n_frames_per_step', type=int, default=1)
+  args = parser.parse_args()
+
+  generator = torch.Generator().manual_seed(1234)
+  packer = PaddedBatchPacker(n_buffers=2)
+  for batch_size in args.batch_sizes:
+    batches = [random_batch(batch_size, generator=generator) for _ in range(args.n_batches)]
+    for batch in batches:
+      expected = reference_collate(batch, args.n_frames_per_step)
+      packed = packer.pack_text_mel(batch, args.n_frames_per_step)[:4]
+      for x, y in zip(expected, packed):
+        assert x.dtype == y.dtype and torch.equal(x, y)
+
+    t_ref = timeit(lambda: [reference_collate(b, args.n_frames_per_step) for b in batches], n_iters=1) / len(batches)
+    t_new = timeit(lambda: [packer.pack_text_mel(b, args.n_frames_per_step) for b in batches], n_iters=1) / len(batches)
+    print("batch {:4d}: loop {:7.2f} ms, packed {:7.2f} ms ({:.1f}x)".format(
+      batch_size, t_ref * 1e3, t_new * 1e3, t_ref / t_new))
+
+
+if __name__ == "__main__":
+  main()
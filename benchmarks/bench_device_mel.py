@@ -0,0 +1,74 @@
+""" Batched mel extraction of padded signals against the per-sample path.
+
+  python -m benchmarks.bench_device_mel --device cpu --batch_sizes 8 32
+"""
+import argparse
+import torch
+
+import commons
+import utils
+from data_utils import PaddedBatchPacker
+from benchmarks.timing import timeit
+
+
+def random_signals(batch_size, sampling_rate, generator=None):
+  signals = []
+  for _ in range(batch_size):
+    n = int(torch.randint(sampling_rate, 8 * sampling_rate, (1,), generator=generator))
+    signals.append(torch.rand(n, generator=generator) * 1.8 - 0.9)
+  return signals
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('-c', '--config', type=str, default="./configs/base.json")
+  parser.add_argument('--device', type=str, default="cpu")
+  parser.add_argument('--batch_sizes', type=int, nargs='+', default=[8, 32])
+  args = parser.parse_args()
+
+  hps = utils.get_hparams_from_file(args.config).data
+  stft = commons.TacotronSTFT(
+      hps.filter_length, hps.hop_length, hps.win_length,
+      hps.n_mel_channels, hps.sampling_rate, hps.mel_fmin,
+      hps.mel_fmax)
+  device_stft = commons.TacotronSTFT(
+      hps.filter_length, hps.hop_length, hps.win_length,
+      hps.n_mel_channels, hps.sampling_rate, hps.mel_fmin,
+      hps.mel_fmax).to(args.device)
+
+  generator = torch.Generator().manual_seed(1234)
+  packer = PaddedBatchPacker(n_buffers=2)
+  for batch_size in args.batch_sizes:
+    signals = random_signals(batch_size, hps.sampling_rate, generator)
+    # per-sample path: one mel per item, padded by the collate
+    batch = [(torch.ones(1), stft.mel_spectrogram(x.unsqueeze(0)).squeeze(0)) for x in signals]
+    _, _, mel_padded, mel_lengths, ids = packer.pack_text_mel(batch)
+    mel_padded = mel_padded.clone()
+    # device path: padded signals, one batched transform
+    _, _, y, y_lengths, _ = packer.pack_text_mel([(torch.ones(1), x) for x in signals])
+    y, y_lengths = y.to(args.device), y_lengths.to(args.device)
+    with torch.no_grad():
+      mel = device_stft.mel_spectrogram(y, y_lengths)
+    assert torch.equal(device_stft.num_frames(y_lengths).cpu(), mel_lengths)
+    assert mel.shape == mel_padded.shape
+    max_diff = (mel.cpu() - mel_padded).abs().max().item()
+    print("batch {:3d}: max |diff| {:.2e}".format(batch_size, max_diff))
+    assert max_diff < 1e-3
+
+    def per_sample():
+      for x in signals:
+        stft.mel_spectrogram(x.unsqueeze(0))
+
+    def batched():
+      device_stft.mel_spectrogram(y, y_lengths)
+      if y.is_cuda:
+        torch.cuda.synchronize()
+
+    with torch.no_grad():
+      t_ref, t_new = timeit(per_sample, n_iters=3), timeit(batched, n_iters=3)
+    print("           per-sample (cpu) {:7.1f} ms, batched ({}) {:7.1f} ms".format(
+      t_ref * 1e3, args.device, t_new * 1e3))
+
+
+if __name__ == "__main__":
+  main()
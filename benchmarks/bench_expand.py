@@ -0,0 +1,72 @@
+""" Expanding the prior from tokens to frames: dense alignment matmuls against index gathers.
+
+  python -m benchmarks.bench_expand --device cpu --batch_size 32 --lengths 200x800
+
+Both expand x_m and x_logs by the same random durations, forward and backward, and are
+checked to agree. "dense" includes building the path with generate_path, as generation did.
+"""
+import argparse
+import torch
+
+import commons
+from benchmarks.bench_logp_memory import format_mb, peak_bytes
+from benchmarks.timing import timeit
+
+
+def expand_dense(x_m, x_logs, durations, mask):
+  attn = commons.generate_path(durations, mask)
+  z_m = torch.matmul(attn.transpose(1, 2), x_m.transpose(1, 2)).transpose(1, 2)
+  z_logs = torch.matmul(attn.transpose(1, 2), x_logs.transpose(1, 2)).transpose(1, 2)
+  return z_m, z_logs
+
+
+def expand_gather(x_m, x_logs, durations, mask):
+  index = commons.duration_index(durations, mask.size(2))
+  z_mask = mask[:, :1, :]
+  return commons.expand_by_index(x_m, index) * z_mask, commons.expand_by_index(x_logs, index) * z_mask
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--device', type=str, default="cpu")
+  parser.add_argument('--batch_size', type=int, default=32)
+  parser.add_argument('--lengths', type=str, default="200x800", help='t_x x t_y')
+  parser.add_argument('--channels', type=int, default=80)
+  args = parser.parse_args()
+
+  device = torch.device(args.device)
+  t_x, t_y = [int(x) for x in args.lengths.split("x")]
+  generator = torch.Generator().manual_seed(1234)
+  x_lengths = torch.randint(t_x // 2, t_x + 1, (args.batch_size,), generator=generator)
+  x_lengths[0] = t_x
+  x_mask = commons.sequence_mask(x_lengths, t_x).float()
+  durations = torch.randint(1, 2 * t_y // t_x, (args.batch_size, t_x), generator=generator).float() * x_mask
+  y_lengths = torch.clamp(durations.sum(1).long(), max=t_y)
+  t_y = int(y_lengths.max())
+  mask = (x_mask.unsqueeze(2) * commons.sequence_mask(y_lengths, t_y).unsqueeze(1).float()).to(device)
+  durations = durations.to(device)
+  x_m = torch.randn(args.batch_size, args.channels, t_x, generator=generator).to(device).requires_grad_()
+  x_logs = torch.randn(args.batch_size, args.channels, t_x, generator=generator).to(device).requires_grad_()
+
+  def step(expand):
+    z_m, z_logs = expand(x_m, x_logs, durations, mask)
+    (z_m.square().sum() + z_logs.sum()).backward()
+    return z_m, z_logs
+
+  results = {}
+  for name, expand in [("dense", expand_dense), ("gather", expand_gather)]:
+    x_m.grad = x_logs.grad = None
+    outputs = step(expand)
+    results[name] = [t.detach() for t in outputs] + [x_m.grad, x_logs.grad]
+    with torch.no_grad():
+      peak_fwd = peak_bytes(lambda: expand(x_m, x_logs, durations, mask), device)
+      t_fwd = timeit(lambda: expand(x_m, x_logs, durations, mask), device)
+    t_step = timeit(lambda: step(expand), device)
+    print("{:>6}: forward {:8.2f} ms (peak {}), forward + backward {:8.2f} ms".format(
+      name, t_fwd * 1e3, format_mb(peak_fwd), t_step * 1e3))
+  for a, b in zip(results["dense"], results["gather"]):
+    assert torch.allclose(a, b, atol=1e-5), (a - b).abs().max()
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,65 @@
+""" Memory that forked readers copy from a list-of-lists filelist vs a PackedFilelist.
+
+  python -m benchmarks.bench_filelist_memory --filelist filelists/train.txt --repeat 10 --workers 1 4 8
+
+Every worker reads all rows once, like a DataLoader worker over an epoch, and reports how much
+of the parent's memory it had to copy (Private_Dirty growth, Linux only).
+"""
+import argparse
+import gc
+import multiprocessing as mp
+
+from utils import load_filepaths_and_text, PackedFilelist
+
+
+def private_dirty_kb():
+  with open("/proc/self/smaps_rollup") as f:
+    for line in f:
+      if line.startswith("Private_Dirty:"):
+        return int(line.split()[1])
+  raise RuntimeError("no Private_Dirty in smaps_rollup")
+
+
+def read_all(filelist, queue):
+  before = private_dirty_kb()
+  n_chars = 0
+  for i in range(len(filelist)):
+    row = filelist[i]
+    n_chars += len(row[0]) + len(row[-1])
+  queue.put(private_dirty_kb() - before)
+
+
+def copied_kb(filelist, n_workers):
+  ctx = mp.get_context("fork")
+  queue = ctx.Queue()
+  workers = [ctx.Process(target=read_all, args=(filelist, queue)) for _ in range(n_workers)]
+  for w in workers:
+    w.start()
+  copied = [queue.get() for _ in workers]
+  for w in workers:
+    w.join()
+  return sum(copied)
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--filelist', type=str, default="filelists/train.txt")
+  parser.add_argument('--repeat', type=int, default=10, help='inflate the filelist this many times')
+  parser.add_argument('--workers', type=int, nargs='+', default=[1, 4, 8])
+  args = parser.parse_args()
+
+  rows = load_filepaths_and_text(args.filelist) * args.repeat
+  rows = [list(row) for row in rows]
+  packed = PackedFilelist(rows)
+  print("{} rows".format(len(rows)))
+  for name, filelist in [("list", rows), ("packed", packed)]:
+    gc.collect()
+    gc.freeze()  # keep the collector itself from touching every object
+    for n_workers in args.workers:
+      print("{:>6}, {} workers: {:8.1f} MB copied in total".format(
+        name, n_workers, copied_kb(filelist, n_workers) / 1024))
+    gc.unfreeze()
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,120 @@
+""" Peak memory and time of the log-likelihood matrix fed to the alignment search.
+
+  python -m benchmarks.bench_logp_memory --device cpu --batch_size 16 --lengths 400x1600 --chunk_sizes 0 512 128
+
+Compares the sum of four [b, t_x, t_y] terms the model used to build against
+commons.log_likelihood_matrix, unchunked (0) and in chunks of frames. Peak memory is what
+torch allocated while computing the matrix, inputs excluded: the CUDA allocator statistics on
+GPUs, storages tracked through a dispatch mode on the CPU (torch >= 2.0, not reported before).
+"""
+import argparse
+import math
+import weakref
+import torch
+
+import commons
+from benchmarks.timing import timeit
+
+
+def cpu_peak_memory():
+  """ A dispatch mode that tracks the bytes of the storages torch ops create while active,
+  live and at their peak, or None where torch has no public-enough dispatch modes (< 2.0) """
+  if tuple(int(v) for v in torch.__version__.split(".")[:2]) < (2, 0):
+    return None
+  from torch.utils._python_dispatch import TorchDispatchMode
+  from torch.utils._pytree import tree_map_only
+
+  class CPUPeakMemory(TorchDispatchMode):
+    def __init__(self):
+      super().__init__()
+      self.live = {}
+      self.current = self.peak = 0
+
+    def _release(self, key):
+      self.current -= self.live.pop(key)
+
+    def _track(self, tensor, inputs):
+      storage = tensor.untyped_storage()
+      key = storage.data_ptr()
+      if key in self.live or key in inputs or storage.nbytes() == 0:
+        return  # already counted, or allocated before (e.g. written to with out=)
+      self.live[key] = storage.nbytes()
+      self.current += storage.nbytes()
+      self.peak = max(self.peak, self.current)
+      weakref.finalize(storage, self._release, key)
+
+    def __torch_dispatch__(self, func, types, args=(), kwargs=None):
+      inputs = set()
+      tree_map_only(torch.Tensor, lambda t: inputs.add(t.untyped_storage().data_ptr()), (args, kwargs))
+      out = func(*args, **(kwargs or {}))
+      tree_map_only(torch.Tensor, lambda t: self._track(t, inputs), out)
+      return out
+
+  return CPUPeakMemory()
+
+
+def logp_reference(z, x_m, x_logs):
+  x_s_sq_r = torch.exp(-2 * x_logs)
+  logp1 = torch.sum(-0.5 * math.log(2 * math.pi) - x_logs, [1]).unsqueeze(-1) # [b, t, 1]
+  logp2 = torch.matmul(x_s_sq_r.transpose(1,2), -0.5 * (z ** 2)) # [b, t, d] x [b, d, t'] = [b, t, t']
+  logp3 = torch.matmul((x_m * x_s_sq_r).transpose(1,2), z) # [b, t, d] x [b, d, t'] = [b, t, t']
+  logp4 = torch.sum(-0.5 * (x_m ** 2) * x_s_sq_r, [1]).unsqueeze(-1) # [b, t, 1]
+  return logp1 + logp2 + logp3 + logp4 # [b, t, t']
+
+
+def peak_bytes(fn, device):
+  """ Peak of the memory allocated by fn, the memory its result keeps included; None on the
+  CPU with torch < 2.0, where it is not tracked """
+  if device.type == "cuda":
+    torch.cuda.synchronize()
+    base = torch.cuda.memory_allocated()
+    torch.cuda.reset_peak_memory_stats()
+    out = fn()
+    torch.cuda.synchronize()
+    return torch.cuda.max_memory_allocated() - base
+  tracker = cpu_peak_memory()
+  if tracker is None:
+    return None
+  with tracker:
+    out = fn()
+  return tracker.peak
+
+
+def format_mb(nbytes):
+  return "{:7.1f} MB".format(nbytes / 2**20) if nbytes is not None else "    n/a   "
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--device', type=str, default="cpu")
+  parser.add_argument('--batch_size', type=int, default=16)
+  parser.add_argument('--lengths', type=str, default="400x1600", help='t_x x t_y')
+  parser.add_argument('--channels', type=int, default=80)
+  parser.add_argument('--chunk_sizes', type=int, nargs='+', default=[0, 512, 128])
+  args = parser.parse_args()
+
+  device = torch.device(args.device)
+  t_x, t_y = [int(x) for x in args.lengths.split("x")]
+  generator = torch.Generator().manual_seed(1234)
+  z = torch.randn(args.batch_size, args.channels, t_y, generator=generator).to(device)
+  x_m = torch.randn(args.batch_size, args.channels, t_x, generator=generator).to(device)
+  x_logs = (torch.rand(args.batch_size, args.channels, t_x, generator=generator) - 0.5).to(device)
+  matrix_mb = args.batch_size * t_x * t_y * 4 / 2**20
+
+  with torch.no_grad():
+    reference = logp_reference(z, x_m, x_logs)
+    runs = [("four terms", lambda: logp_reference(z, x_m, x_logs))]
+    for chunk_size in args.chunk_sizes:
+      runs.append(("fused, chunks of {}".format(chunk_size or t_y),
+          lambda chunk_size=chunk_size: commons.log_likelihood_matrix(z, x_m, x_logs, chunk_size)))
+    print("{}x{}, batch {}: one [b, t_x, t_y] matrix is {:.1f} MB".format(t_x, t_y, args.batch_size, matrix_mb))
+    for name, fn in runs:
+      error = (fn() - reference).abs().max().item()
+      peak = peak_bytes(fn, device)
+      matrices = "{:4.2f}".format(peak / 2**20 / matrix_mb) if peak is not None else " n/a"
+      print("{:>22}: peak {} ({} matrices), {:8.2f} ms, max abs diff {:.2e}".format(
+        name, format_mb(peak), matrices, timeit(fn, device) * 1e3, error))
+
+
+if __name__ == "__main__":
+  main()
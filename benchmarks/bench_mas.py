@@ -0,0 +1,54 @@
+""" Torch monotonic alignment search against the Cython extension.
+
+  python -m benchmarks.bench_mas --device cpu --batch_sizes 1 8 32 --lengths 100x400 200x800
+
+Paths are checked to be identical, then both are timed end to end (the Cython version
+includes its copies to and from the host).
+"""
+import argparse
+import torch
+
+import commons
+import monotonic_align
+from benchmarks.timing import timeit
+
+
+def random_inputs(batch_size, t_x, t_y, device, generator=None):
+  x_lengths = torch.randint(t_x // 2, t_x + 1, (batch_size,), generator=generator)
+  y_lengths = torch.randint(t_y // 2, t_y + 1, (batch_size,), generator=generator)
+  x_lengths[0], y_lengths[0] = t_x, t_y
+  y_lengths = torch.maximum(y_lengths, x_lengths)
+  mask = commons.sequence_mask(x_lengths, t_x).unsqueeze(2) & commons.sequence_mask(y_lengths, t_y).unsqueeze(1)
+  value = -torch.rand(batch_size, t_x, t_y, generator=generator) * 100
+  return value.to(device), mask.float().to(device)
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--device', type=str, default="cpu")
+  parser.add_argument('--batch_sizes', type=int, nargs='+', default=[1, 8, 32])
+  parser.add_argument('--lengths', type=str, nargs='+', default=["100x400", "200x800"],
+                      help='t_x x t_y')
+  parser.add_argument('--threads', type=int, default=None, help='torch intra-op threads')
+  args = parser.parse_args()
+
+  if args.threads is not None:
+    torch.set_num_threads(args.threads)
+  device = torch.device(args.device)
+  generator = torch.Generator().manual_seed(1234)
+  for lengths in args.lengths:
+    t_x, t_y = [int(x) for x in lengths.split("x")]
+    for batch_size in args.batch_sizes:
+      value, mask = random_inputs(batch_size, t_x, t_y, device, generator)
+      path_c = monotonic_align.maximum_path_cython(value, mask)
+      path_t = monotonic_align.maximum_path_torch(value, mask)
+      assert torch.equal(path_c, path_t)
+
+      t_c = timeit(lambda: monotonic_align.maximum_path_cython(value, mask), device)
+      t_t = timeit(lambda: monotonic_align.maximum_path_torch(value, mask), device)
+      print("{:>8} batch {:3d}: cython {:8.2f} ms, torch ({}) {:8.2f} ms".format(
+        lengths, batch_size, t_c * 1e3, args.device, t_t * 1e3))
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,58 @@
+""" Banded monotonic alignment search against the full search, on converged-looking alignments.
+
+  python -m benchmarks.bench_mas_band --batch_size 32 --lengths 200x800 --widths 4 8 16 32
+
+`value` peaks around a random monotonic alignment (plus noise), like logp late in training.
+Reports how many paths differ from the full search and how many items fell back to it.
+"""
+import argparse
+import torch
+
+import commons
+import monotonic_align
+from benchmarks.timing import timeit
+
+
+def converged_inputs(batch_size, t_x, t_y, generator=None):
+  x_lengths = torch.randint(t_x // 2, t_x + 1, (batch_size,), generator=generator)
+  x_lengths[0] = t_x
+  durations = torch.rand(batch_size, t_x, generator=generator) * 6 + 1
+  durations = durations * commons.sequence_mask(x_lengths, t_x)
+  durations = torch.ceil(durations * (t_y / t_x / 4.5))
+  y_lengths = torch.clamp(durations.sum(1).long(), max=t_y)
+  y_lengths = torch.maximum(y_lengths, x_lengths)
+  mask = (commons.sequence_mask(x_lengths, t_x).unsqueeze(2) & commons.sequence_mask(y_lengths, t_y).unsqueeze(1)).float()
+
+  # distance of every cell to the token a frame belongs to in the "true" alignment
+  lo, _ = monotonic_align.alignment_band(durations, t_y, 0)
+  x = torch.arange(t_x).view(1, t_x, 1)
+  value = -0.5 * (x - lo.unsqueeze(1)).float() ** 2 + torch.randn(batch_size, t_x, t_y, generator=generator)
+  return value, mask, x_lengths, y_lengths
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--batch_size', type=int, default=32)
+  parser.add_argument('--lengths', type=str, default="200x800", help='t_x x t_y')
+  parser.add_argument('--widths', type=int, nargs='+', default=[4, 8, 16, 32])
+  args = parser.parse_args()
+
+  t_x, t_y = [int(x) for x in args.lengths.split("x")]
+  value, mask, x_lengths, y_lengths = converged_inputs(args.batch_size, t_x, t_y, torch.Generator().manual_seed(1234))
+  full = monotonic_align.maximum_path_cython(value, mask)
+  prev_durations = full.sum(-1)
+  print("full search:              {:8.2f} ms".format(timeit(lambda: monotonic_align.maximum_path_cython(value, mask), n_iters=20, best=True) * 1e3))
+
+  for width in args.widths:
+    for name, band in [("diagonal", monotonic_align.diagonal_band(x_lengths, y_lengths, t_y, width)),
+                       ("previous", monotonic_align.alignment_band(prev_durations, t_y, width))]:
+      _, feasible = monotonic_align.maximum_path_cython(value, mask, band=band)
+      path = monotonic_align.maximum_path(value, mask, band=band)
+      n_diff = sum(not torch.equal(path[i], full[i]) for i in range(args.batch_size))
+      elapsed = timeit(lambda: monotonic_align.maximum_path(value, mask, band=band), n_iters=20, best=True)
+      print("{} band +-{:3d}:     {:8.2f} ms, {:2d}/{} paths differ, {:2d} fell back".format(
+        name, width, elapsed * 1e3, n_diff, args.batch_size, int((~feasible).sum())))
+
+
+if __name__ == "__main__":
+  main()
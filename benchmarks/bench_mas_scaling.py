@@ -0,0 +1,56 @@
+""" Thread scaling of the OpenMP monotonic alignment search.
+
+  python -m benchmarks.bench_mas_scaling --batch_size 32 --lengths 200x800 --threads 1 2 4 8
+
+Also times the previous wrapper (fresh buffers and dtype copies on every call) on one thread.
+Build the extension with OpenMP first (monotonic_align/setup.py), otherwise every thread
+count runs serially.
+"""
+import argparse
+import os
+import numpy as np
+import torch
+
+import monotonic_align
+from benchmarks.bench_mas import random_inputs
+from benchmarks.timing import timeit
+
+
+def reference_maximum_path(value, mask):
+  value = value * mask
+  device = value.device
+  dtype = value.dtype
+  value = value.data.cpu().numpy().astype(np.float32)
+  path = np.zeros_like(value).astype(np.int32)
+  mask = mask.data.cpu().numpy()
+
+  t_x_max = mask.sum(1)[:, 0].astype(np.int32)
+  t_y_max = mask.sum(2)[:, 0].astype(np.int32)
+  monotonic_align.maximum_path_c(path, value, t_x_max, t_y_max, -1e9, 1)
+  return torch.from_numpy(path).to(device=device, dtype=dtype)
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--batch_size', type=int, default=32)
+  parser.add_argument('--lengths', type=str, default="200x800", help='t_x x t_y')
+  parser.add_argument('--threads', type=int, nargs='+',
+                      default=[n for n in [1, 2, 4, 8, 16, 32] if n <= os.cpu_count()])
+  args = parser.parse_args()
+
+  t_x, t_y = [int(x) for x in args.lengths.split("x")]
+  value, mask = random_inputs(args.batch_size, t_x, t_y, torch.device("cpu"), torch.Generator().manual_seed(1234))
+  expected = reference_maximum_path(value, mask)
+
+  t_ref = timeit(lambda: reference_maximum_path(value, mask), n_iters=10)
+  print("previous wrapper, 1 thread: {:8.2f} ms".format(t_ref * 1e3))
+  t_one = None
+  for n_threads in args.threads:
+    assert torch.equal(monotonic_align.maximum_path_cython(value, mask, num_threads=n_threads), expected)
+    elapsed = timeit(lambda: monotonic_align.maximum_path_cython(value, mask, num_threads=n_threads), n_iters=10)
+    t_one = t_one or elapsed
+    print("{:2d} threads:                {:8.2f} ms ({:.2f}x)".format(n_threads, elapsed * 1e3, t_one / elapsed))
+
+
+if __name__ == "__main__":
+  main()
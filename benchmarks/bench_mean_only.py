@@ -0,0 +1,82 @@
+""" Training step time of a mean_only model, on its unit-scale path against the general path.
+
+  python -m benchmarks.bench_mean_only -c configs/base.json --device cpu --batch_size 8 --lengths 100x400
+
+The general path is what mean_only models took before: the encoder returns zero log-scales,
+which every later step then carries along. Both run forward, loss and backward on the same
+random batch and weights; alignments, losses and gradients are compared.
+"""
+import argparse
+import torch
+
+import commons
+import models
+import utils
+from text.symbols import symbols
+from benchmarks.timing import timeit
+
+
+def zero_log_scales(encoder):
+  """ Makes a mean_only encoder return zeros instead of None for x_logs """
+  forward = encoder.forward
+  def forward_with_zeros(*args, **kwargs):
+    x_m, x_logs, logw, x_mask = forward(*args, **kwargs)
+    return x_m, torch.zeros_like(x_m), logw, x_mask
+  encoder.forward = forward_with_zeros
+
+
+def step(generator, x, x_lengths, y, y_lengths):
+  generator.zero_grad()
+  (z, z_m, z_logs, logdet, z_mask), _, (attn, logw, logw_) = generator(x, x_lengths, y, y_lengths, gen=False)
+  l_mle = commons.mle_loss(z, z_m, z_logs, logdet, z_mask)
+  loss = l_mle + commons.duration_loss(logw, logw_, x_lengths)
+  loss.backward()
+  return attn, l_mle
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('-c', '--config', type=str, default="./configs/base.json")
+  parser.add_argument('--device', type=str, default="cpu")
+  parser.add_argument('--batch_size', type=int, default=8)
+  parser.add_argument('--lengths', type=str, default="100x400", help='t_x x t_y')
+  parser.add_argument('--n_iters', type=int, default=5)
+  args = parser.parse_args()
+
+  hps = utils.get_hparams_from_file(args.config)
+  assert hps.model.mean_only, "the config has to be mean_only"
+  device = torch.device(args.device)
+  t_x, t_y = [int(x) for x in args.lengths.split("x")]
+  generator = torch.Generator().manual_seed(1234)
+  x_lengths = torch.randint(t_x // 2, t_x + 1, (args.batch_size,), generator=generator)
+  y_lengths = torch.randint(t_y // 2, t_y + 1, (args.batch_size,), generator=generator)
+  x_lengths[0], y_lengths[0] = t_x, t_y
+  x = torch.randint(1, len(symbols), (args.batch_size, t_x), generator=generator) * commons.sequence_mask(x_lengths, t_x)
+  y = torch.randn(args.batch_size, hps.data.n_mel_channels, t_y, generator=generator) * commons.sequence_mask(y_lengths, t_y).unsqueeze(1)
+  batch = [t.to(device) for t in [x, x_lengths, y, y_lengths]]
+
+  torch.manual_seed(hps.train.seed)
+  unit = models.FlowGenerator(n_vocab=len(symbols) + getattr(hps.data, "add_blank", False),
+      out_channels=hps.data.n_mel_channels, **hps.model).to(device)
+  general = models.FlowGenerator(n_vocab=len(symbols) + getattr(hps.data, "add_blank", False),
+      out_channels=hps.data.n_mel_channels, **hps.model).to(device)
+  step(unit, *batch)  # data-dependent initialization of the ActNorm layers
+  general.load_state_dict(unit.state_dict())
+  zero_log_scales(general.encoder)
+
+  results = {}
+  for name, model in [("general", general), ("mean_only", unit)]:
+    torch.manual_seed(hps.train.seed)  # same dropout masks
+    attn, l_mle = step(model, *batch)
+    results[name] = (attn, l_mle.item(), [p.grad.clone() for p in model.parameters() if p.grad is not None])
+    print("{:>9}: {:8.1f} ms per step, mle loss {:.6f}".format(
+      name, timeit(lambda: step(model, *batch), device, args.n_iters) * 1e3, l_mle.item()))
+
+  (attn_g, loss_g, grads_g), (attn_u, loss_u, grads_u) = results["general"], results["mean_only"]
+  grad_diff = max((a - b).abs().max().item() for a, b in zip(grads_g, grads_u))
+  print("same alignments: {}, loss difference {:.2e}, largest gradient difference {:.2e}".format(
+    torch.equal(attn_g, attn_u), abs(loss_g - loss_u), grad_diff))
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,70 @@
+""" Text encoder with banded relative attention against the padded relative reshapes.
+
+  python -m benchmarks.bench_relative_attention -c configs/base.json --device cpu --batch_size 16 --lengths 50 100 200 400 600
+
+Times forward and forward + backward of the attention encoder of the config for both
+settings of MultiHeadAttention.relative_band, on the same weights, and checks that outputs
+and gradients agree.
+"""
+import argparse
+import torch
+
+import attentions
+import commons
+import utils
+from benchmarks.timing import timeit
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('-c', '--config', type=str, default="./configs/base.json")
+  parser.add_argument('--device', type=str, default="cpu")
+  parser.add_argument('--batch_size', type=int, default=16)
+  parser.add_argument('--lengths', type=int, nargs='+', default=[50, 100, 200, 400, 600])
+  parser.add_argument('--n_iters', type=int, default=5)
+  args = parser.parse_args()
+
+  hps = utils.get_hparams_from_file(args.config)
+  device = torch.device(args.device)
+  torch.manual_seed(1234)
+  encoder = attentions.Encoder(
+      getattr(hps.model, "hidden_channels_enc", None) or hps.model.hidden_channels,
+      hps.model.filter_channels,
+      hps.model.n_heads,
+      hps.model.n_layers_enc,
+      hps.model.kernel_size,
+      0.,  # no dropout, so that both runs see the same computation
+      window_size=hps.model.window_size,
+      block_length=getattr(hps.model, "block_length", None)).to(device)
+  print("window_size {}".format(hps.model.window_size))
+
+  for length in args.lengths:
+    x_lengths = torch.randint(length // 2, length + 1, (args.batch_size,))
+    x_lengths[0] = length
+    x_mask = commons.sequence_mask(x_lengths, length).unsqueeze(1).float().to(device)
+    x = torch.randn(args.batch_size, encoder.hidden_channels, length, device=device, requires_grad=True)
+
+    def forward():
+      with torch.no_grad():
+        return encoder(x, x_mask)
+
+    def step():
+      encoder.zero_grad()
+      x.grad = None
+      y = encoder(x, x_mask)
+      y.square().sum().backward()
+      return y.detach(), x.grad
+
+    times, results = {}, {}
+    for band in [False, True]:
+      attentions.MultiHeadAttention.relative_band = band
+      results[band] = step()
+      times[band] = (timeit(forward, device, args.n_iters), timeit(step, device, args.n_iters))
+    diff = max((a - b).abs().max().item() for a, b in zip(results[False], results[True]))
+    print("length {:4d}: forward {:8.2f} -> {:8.2f} ms, forward + backward {:8.2f} -> {:8.2f} ms, max diff {:.1e}".format(
+      length, times[False][0] * 1e3, times[True][0] * 1e3, times[False][1] * 1e3, times[True][1] * 1e3, diff))
+  attentions.MultiHeadAttention.relative_band = True
+
+
+if __name__ == "__main__":
+  main()
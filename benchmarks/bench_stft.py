@@ -0,0 +1,69 @@
+""" Batched STFT/iSTFT against the per-row librosa loop it replaced.
+
+  python -m benchmarks.bench_stft --batch_sizes 1 8 32 --seconds 6
+"""
+import argparse
+import numpy as np
+import torch
+from librosa import stft, istft
+
+from stft import STFT
+from benchmarks.timing import timeit
+
+
+def librosa_transform(stft_fn, input_data):
+  x = input_data.detach().numpy()
+  real_part = []
+  imag_part = []
+  for y in x:
+    y_ = stft(y, n_fft=stft_fn.filter_length, hop_length=stft_fn.hop_length, win_length=stft_fn.win_length, window=stft_fn.window, pad_mode='reflect')
+    real_part.append(y_.real[None,:,:])
+    imag_part.append(y_.imag[None,:,:])
+  real_part = torch.from_numpy(np.concatenate(real_part, 0)).to(input_data.dtype)
+  imag_part = torch.from_numpy(np.concatenate(imag_part, 0)).to(input_data.dtype)
+  magnitude = torch.sqrt(real_part**2 + imag_part**2)
+  phase = torch.atan2(imag_part.data, real_part.data)
+  return magnitude, phase
+
+
+def librosa_inverse(stft_fn, magnitude, phase):
+  x = (magnitude * torch.exp(1j * phase)).numpy()
+  inverse_transform = []
+  for y in x:
+    y_ = istft(y, hop_length=stft_fn.hop_length, win_length=stft_fn.win_length, window=stft_fn.window)
+    inverse_transform.append(y_[None,:])
+  return torch.from_numpy(np.concatenate(inverse_transform, 0)).to(magnitude.dtype)
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--batch_sizes', type=int, nargs='+', default=[1, 8, 32])
+  parser.add_argument('--seconds', type=float, default=6.)
+  parser.add_argument('--n_iters', type=int, default=5)
+  parser.add_argument('--threads', type=int, default=None)
+  args = parser.parse_args()
+  if args.threads is not None:
+    torch.set_num_threads(args.threads)
+
+  stft_fn = STFT(1024, 256, 1024)
+  n_samples = int(args.seconds * 22050)
+  print("batch | stft librosa (ms) | stft batched (ms) | istft librosa (ms) | istft batched (ms) | max |mag| diff | max wav diff")
+  for b in args.batch_sizes:
+    x = torch.rand(b, n_samples) * 2 - 1
+    mag_ref, phase_ref = librosa_transform(stft_fn, x)
+    mag, phase = stft_fn.transform(x)
+    wav_ref = librosa_inverse(stft_fn, mag_ref, phase_ref)
+    wav = stft_fn.inverse(mag_ref, phase_ref)
+    mag_diff = (mag - mag_ref).abs().max().item()
+    wav_diff = (wav - wav_ref).abs().max().item()
+
+    t_stft_ref = timeit(lambda: librosa_transform(stft_fn, x), n_iters=args.n_iters)
+    t_stft = timeit(lambda: stft_fn.transform(x), n_iters=args.n_iters)
+    t_istft_ref = timeit(lambda: librosa_inverse(stft_fn, mag_ref, phase_ref), n_iters=args.n_iters)
+    t_istft = timeit(lambda: stft_fn.inverse(mag_ref, phase_ref), n_iters=args.n_iters)
+    print("{:5d} | {:17.1f} | {:17.1f} | {:18.1f} | {:18.1f} | {:14.2e} | {:.2e}".format(
+      b, 1e3 * t_stft_ref, 1e3 * t_stft, 1e3 * t_istft_ref, 1e3 * t_istft, mag_diff, wav_diff))
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,29 @@
+""" Timing helper shared by the benchmarks. """
+import time
+import torch
+
+
+def timeit(fn, device=None, n_iters=5, best=False):
+  """ Seconds per call of fn() after one warm-up call: the mean of `n_iters` calls, or with
+  best=True the fastest of them (for calls short enough for other load to skew a mean).
+  CUDA work is waited for if `device` is a CUDA device.
+  """
+  def sync():
+    if device is not None and torch.device(device).type == "cuda":
+      torch.cuda.synchronize()
+
+  fn()
+  sync()
+  if best:
+    fastest = float("inf")
+    for _ in range(n_iters):
+      start = time.perf_counter()
+      fn()
+      sync()
+      fastest = min(fastest, time.perf_counter() - start)
+    return fastest
+  start = time.perf_counter()
+  for _ in range(n_iters):
+    fn()
+  sync()
+  return (time.perf_counter() - start) / n_iters
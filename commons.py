@@ -17,7 +17,11 @@ def intersperse(lst, item):
 
 
 def mle_loss(z, m, logs, logdet, mask):
-  l = torch.sum(logs) + 0.5 * torch.sum(torch.exp(-2 * logs) * ((z - m)**2)) # neg normal likelihood w/o the constant term
+  """ logs: None for unit scales (mean_only) """
+  if logs is None:
+    l = 0.5 * torch.sum((z - m)**2) # neg normal likelihood w/o the constant term
+  else:
+    l = torch.sum(logs) + 0.5 * torch.sum(torch.exp(-2 * logs) * ((z - m)**2)) # neg normal likelihood w/o the constant term
   l = l - torch.sum(logdet) # log jacobian determinant
   l = l / torch.sum(torch.ones_like(z) * mask) # averaging across batch, channel and time axes
   l = l + 0.5 * math.log(2 * math.pi) # add the remaining constant term
@@ -29,6 +33,36 @@ def duration_loss(logw, logw_, lengths):
   return l
 
 
+def log_likelihood_matrix(z, m, logs, chunk_size=None):
+  """ log N(z[:, :, j]; m[:, :, i], exp(logs[:, :, i])) summed over channels, [b, t_x, t_y]
+  z: [b, d, t_y]
+  m, logs: [b, d, t_x], logs None for unit scales (mean_only)
+  Expanded to one batched matmul plus a per-token bias. With chunk_size, computed for that many
+  frames at a time into the output, the only full [b, t_x, t_y] tensor allocated.
+  """
+  if logs is None:
+    # -0.5 * |z - m|^2 + const: a matmul of the means alone, plus a bias per token and per frame
+    bias = torch.sum(-0.5 * math.log(2 * math.pi) - 0.5 * (m ** 2), [1]).unsqueeze(-1) # [b, t_x, 1]
+    weight = m.transpose(1, 2) # [b, t_x, d]
+  else:
+    s_sq_r = torch.exp(-2 * logs)
+    bias = torch.sum(-0.5 * math.log(2 * math.pi) - logs - 0.5 * (m ** 2) * s_sq_r, [1]).unsqueeze(-1) # [b, t_x, 1]
+    weight = torch.cat([s_sq_r, m * s_sq_r], 1).transpose(1, 2) # [b, t_x, 2d]
+
+  def chunk_logp(z_chunk):
+    if logs is None:
+      return torch.baddbmm(bias, weight, z_chunk).add_(torch.sum(-0.5 * (z_chunk ** 2), [1]).unsqueeze(1)) # + [b, 1, t_y]
+    return torch.baddbmm(bias, weight, torch.cat([-0.5 * (z_chunk ** 2), z_chunk], 1))
+
+  b, t_x, t_y = z.size(0), m.size(2), z.size(2)
+  if not chunk_size or chunk_size >= t_y:
+    return chunk_logp(z)
+  out = z.new_empty(b, t_x, t_y)
+  for start in range(0, t_y, chunk_size):
+    out[:, :, start:start + chunk_size] = chunk_logp(z[:, :, start:start + chunk_size])
+  return out
+
+
 @torch.jit.script
 def fused_add_tanh_sigmoid_multiply(input_a, input_b, n_channels):
   n_channels_int = n_channels[0]
@@ -114,6 +148,24 @@ def generate_path(duration, mask):
   return path
 
 
+def duration_index(duration, t_y):
+  """ [b, t_y] index of the token each frame belongs to, the sparse form of generate_path
+  (frames past the last duration get the last token)
+  duration: [b, t_x]
+  """
+  b, t_x = duration.shape
+  cum_duration = torch.cumsum(duration, 1).contiguous()
+  frames = torch.arange(t_y, device=duration.device, dtype=cum_duration.dtype).expand(b, t_y).contiguous()
+  return torch.searchsorted(cum_duration, frames, right=True).clamp_max_(t_x - 1)
+
+
+def expand_by_index(x, index):
+  """ x: [b, d, t_x], index: [b, t_y] -> [b, d, t_y], x[:, :, index] for every item. Equals the
+  matmul of x with a hard alignment, without building it.
+  """
+  return torch.gather(x, 2, index.unsqueeze(1).expand(-1, x.size(1), -1))
+
+
 class Adam():
   def __init__(self, params, scheduler, dim_model, warmup_steps=4000, lr=1e0, betas=(0.9, 0.98), eps=1e-9):
     self.params = params
@@ -135,8 +187,9 @@ class Adam():
     else:
       return 1
 
-  def _update_learning_rate(self):
-    self.step_num += 1
+  def _update_learning_rate(self, step_scale=1):
+    # step_scale: size of the batch relative to the reference batch size the schedule was tuned for
+    self.step_num += step_scale
     if self.scheduler == "noam":
       self.cur_lr = self.lr * self._get_lr_scale()
       for param_group in self._optim.param_groups:
@@ -145,9 +198,9 @@ class Adam():
   def get_lr(self):
     return self.cur_lr
 
-  def step(self):
+  def step(self, step_scale=1):
     self._optim.step()
-    self._update_learning_rate()
+    self._update_learning_rate(step_scale)
 
   def zero_grad(self):
     self._optim.zero_grad()
@@ -180,11 +233,16 @@ class TacotronSTFT(nn.Module):
     output = dynamic_range_decompression(magnitudes)
     return output
 
-  def mel_spectrogram(self, y):
+  def num_frames(self, num_samples):
+    return num_samples // self.stft_fn.hop_length + 1
+
+  def mel_spectrogram(self, y, y_lengths=None):
     """Computes mel-spectrograms from a batch of waves
     PARAMS
     ------
     y: Variable(torch.FloatTensor) with shape (B, T) in range [-1, 1]
+    y_lengths: optional (B,) valid samples of each row if y is a zero-padded batch. Each row
+      then gives the mel it would on its own, zero-padded past num_frames(y_lengths).
 
     RETURNS
     -------
@@ -193,10 +251,13 @@ class TacotronSTFT(nn.Module):
     assert(torch.min(y.data) >= -1)
     assert(torch.max(y.data) <= 1)
 
-    magnitudes, phases = self.stft_fn.transform(y)
+    magnitudes, phases = self.stft_fn.transform(y, y_lengths)
     magnitudes = magnitudes.data
     mel_output = torch.matmul(self.mel_basis, magnitudes)
     mel_output = self.spectral_normalize(mel_output)
+    if y_lengths is not None:
+      mel_mask = sequence_mask(self.num_frames(y_lengths), mel_output.size(2)).unsqueeze(1)
+      mel_output = mel_output * mel_mask.to(mel_output.dtype)
     return mel_output
 
 
@@ -1,13 +1,17 @@
+import os
 import random
+import logging
 import numpy as np
 import torch
 import torch.utils.data
 from dataclasses import dataclass
 
 import commons 
-from utils import load_wav_to_torch, load_filepaths_and_text
+from utils import load_wav_to_torch, load_filepaths_and_text, load_packed_filepaths_and_text, load_wav_lengths, PackedFilelist
 from text import text_to_sequence, cmudict
 from text.symbols import symbols
+from feature_store import MelStore, TokenStore, AudioArchive, FeatureCache, SharedAudioCache
+from feature_store import load_sample_shard_index, iter_sample_shard, mel_params, text_params
 
 
 @dataclass
@@ -16,61 +20,440 @@ class Audio:
     sampling_rate: int
 
 
+def wav_num_samples(filelist, sampling_rate):
+    """ Sample counts of the filelist's audio (in filelist order) from its WAV header index.
+        Files that don't match the target sampling rate are rejected here, rather than mid-epoch.
+    """
+    sampling_rates, num_samples = load_wav_lengths(filelist)
+    mismatched = np.flatnonzero(sampling_rates != sampling_rate)
+    if len(mismatched) > 0:
+        i = mismatched[0]
+        raise ValueError("{} files in {} don't match target {} SR, e.g. {} ({} SR)".format(
+            len(mismatched), filelist, sampling_rate,
+            load_filepaths_and_text(filelist)[i][0], sampling_rates[i]))
+    return num_samples
+
+
 class TextMelLoader(torch.utils.data.Dataset):
     """
         1) loads audio,text pairs
         2) normalizes text and converts them to sequences of one-hot vectors
+        3) computes mel-spectrograms from audio, or loads precomputed ones if load_mel_from_disk
+        4) also returns the signal the mel was computed from if return_signal (for augmentation)
+        5) appends the dataset index of the item if return_ids (for the duration cache)
+
+        With mel_on_device, (text, signal) pairs are returned and mels are computed for whole
+        batches on the training device instead (see TacotronSTFT.mel_spectrogram).
     """
-    def __init__(self, audiopaths_and_text, hparams):
-        self.audiopaths_and_text = load_filepaths_and_text(audiopaths_and_text)
+    def __init__(self, audiopaths_and_text, hparams, return_signal=False, return_ids=False):
+        self.audiopaths_and_text = load_packed_filepaths_and_text(audiopaths_and_text)
+        self.return_signal = return_signal
+        self.return_ids = return_ids
         self.text_cleaners = hparams.text_cleaners
         self.add_noise = hparams.add_noise
         self.max_wav_value = hparams.max_wav_value
         self.sampling_rate = hparams.sampling_rate
+        self.n_mel_channels = hparams.n_mel_channels
+        self.hop_length = hparams.hop_length
+        self.load_mel_from_disk = hparams.load_mel_from_disk
+        self.mel_on_device = getattr(hparams, "mel_on_device", False)
+        if self.mel_on_device and (self.load_mel_from_disk or return_signal):
+            raise ValueError("mel_on_device ships raw signals, it can't be combined with load_mel_from_disk "
+                             "or return_signal (augmentation on the CPU)")
         self.add_blank = getattr(hparams, "add_blank", False) # improved version
         if getattr(hparams, "cmudict_path", None) is not None:
           self.cmudict = cmudict.CMUDict(hparams.cmudict_path)
+        if self.load_mel_from_disk and getattr(hparams, "mel_store_path", None) is not None:
+          self.mel_store = MelStore(hparams.mel_store_path, hparams)
+        if getattr(hparams, "token_store_path", None) is not None:
+          self.token_store = TokenStore.open(hparams.token_store_path, hparams)
+        if not self.load_mel_from_disk and getattr(hparams, "audio_archive_path", None) is not None:
+          self.audio_archive = AudioArchive(hparams.audio_archive_path, self.sampling_rate)
+        if not self.load_mel_from_disk and getattr(hparams, "audio_cache_max_gb", 0) > 0:
+          self.audio_cache = SharedAudioCache(
+              getattr(hparams, "audio_cache_path", "/dev/shm/glowtts_audio_cache"), self.sampling_rate,
+              int(hparams.audio_cache_max_gb * (1 << 30)))
+        if not self.load_mel_from_disk and not self.mel_on_device:
+          self.stft = commons.TacotronSTFT(
+              hparams.filter_length, hparams.hop_length, hparams.win_length,
+              hparams.n_mel_channels, hparams.sampling_rate, hparams.mel_fmin,
+              hparams.mel_fmax)
+          if getattr(hparams, "feature_cache_path", None) is not None:
+            self.feature_cache = FeatureCache(hparams.feature_cache_path, hparams,
+                int(getattr(hparams, "feature_cache_max_gb", 50) * (1 << 30)))
+            if self.add_noise:
+                logging.warning("Mels in the feature cache {} are computed without add_noise, "
+                                "training on them skips the dequantization noise".format(hparams.feature_cache_path))
         random.seed(1234)
-        random.shuffle(self.audiopaths_and_text)
+        self.audiopaths_and_text.shuffle(random)
+        if not self.load_mel_from_disk and getattr(self, "audio_archive", None) is None:
+            self.num_samples = wav_num_samples(audiopaths_and_text, self.sampling_rate)[self.audiopaths_and_text.order]
 
     def get_audio_text_pair(self, audiopath_and_text):
         # separate filename and text
         audiopath, text = audiopath_and_text[0], audiopath_and_text[1]
         text = self.get_text(text)
-        signal, sampling_rate = load_wav_to_torch(audiopath)
+        if self.load_mel_from_disk:
+            melspec = self.get_mel(audiopath)
+            return (text, melspec, melspec) if self.return_signal else (text, melspec)
+        feature_cache = getattr(self, "feature_cache", None)
+        if feature_cache is not None:
+            # augmentation still needs the signal, the cache saves its STFT
+            signal = self.get_signal(audiopath, add_noise=False) if self.return_signal else None
+            melspec = feature_cache.get_mel(audiopath, lambda x: self.signal_to_mel(
+                signal if signal is not None else self.get_signal(x, add_noise=False)))
+            return (text, melspec, signal) if self.return_signal else (text, melspec)
+        signal, melspec = self.get_signal_mel(audiopath, self.add_noise)
+        if self.mel_on_device:
+            return text, signal
+        return (text, melspec, signal) if self.return_signal else (text, melspec)
+
+    def get_signal_mel(self, audiopath, add_noise):
+        """ Normalized signal and its mel (None with mel_on_device) """
+        signal = self.get_signal(audiopath, add_noise)
+        if self.mel_on_device:
+            return signal, None
+        return signal, self.signal_to_mel(signal)
+
+    def get_signal(self, audiopath, add_noise):
+        signal, sampling_rate = self.load_audio(audiopath)
         if sampling_rate != self.sampling_rate:
             raise ValueError("{} {} SR doesn't match target {} SR".format(
                 sampling_rate, self.sampling_rate, self.sampling_rate))
-        if self.add_noise:
+        if add_noise:
             signal = signal + torch.rand_like(signal)
-        signal = signal / self.max_wav_value
-        return text, signal
+        return signal / self.max_wav_value
+
+    def signal_to_mel(self, signal):
+        with torch.no_grad():
+            return self.stft.mel_spectrogram(signal.unsqueeze(0)).squeeze(0)
+
+    def load_audio(self, filename):
+        audio_archive = getattr(self, "audio_archive", None)
+        if audio_archive is not None and filename in audio_archive:
+            return audio_archive.get_audio(filename)
+        audio_cache = getattr(self, "audio_cache", None)
+        if audio_cache is not None:
+            return audio_cache.get_audio(filename)
+        return load_wav_to_torch(filename)
+
+    def get_mel(self, filename):
+        mel_store = getattr(self, "mel_store", None)
+        if mel_store is not None:
+            melspec = mel_store.get_mel(filename)
+        else:
+            melspec = torch.from_numpy(np.load(filename))
+        assert melspec.size(0) == self.n_mel_channels, (
+            'Mel dimension mismatch: given {}, expected {}'.format(
+                melspec.size(0), self.n_mel_channels))
+        return melspec
 
     def get_text(self, text):
+        token_store = getattr(self, "token_store", None)
+        if token_store is not None and text in token_store:
+            return token_store.get_tokens(text)
         text_norm = text_to_sequence(text, self.text_cleaners, getattr(self, "cmudict", None))
         if self.add_blank:
             text_norm = commons.intersperse(text_norm, len(symbols)) # add a blank token, whose id number is len(symbols)
         text_norm = torch.IntTensor(text_norm)
         return text_norm
 
+    def get_lengths(self):
+        """Mel frame counts of all utterances, without decoding any audio."""
+        if getattr(self, "lengths", None) is None:
+            num_samples = getattr(self, "num_samples", None)
+            if num_samples is not None:
+                self.lengths = num_samples // self.hop_length + 1
+            else:
+                self.lengths = np.array([self._get_length(x[0]) for x in self.audiopaths_and_text], dtype=np.int64)
+        return self.lengths
+
+    def _get_length(self, filename):
+        mel_store = getattr(self, "mel_store", None)
+        if mel_store is not None:
+            return int(mel_store.lengths[mel_store.index_of(filename)])
+        if self.load_mel_from_disk:
+            return np.load(filename, mmap_mode='r').shape[-1]
+        audio_archive = getattr(self, "audio_archive", None)
+        if audio_archive is not None and filename in audio_archive:
+            return int(audio_archive.lengths[audio_archive.index_of(filename)]) // self.hop_length + 1
+        # 16-bit mono PCM, the header is negligible
+        return os.path.getsize(filename) // (2 * self.hop_length) + 1
+
     def __getitem__(self, index):
-        return self.get_audio_text_pair(self.audiopaths_and_text[index])
+        item = self.get_audio_text_pair(self.audiopaths_and_text[index])
+        return (*item, index) if self.return_ids else item
 
     def __len__(self):
         return len(self.audiopaths_and_text)
 
 
+class TextMelShardDataset(torch.utils.data.IterableDataset):
+    """
+        Streams samples from tar shards written by `preprocess.py shards`, reading every shard
+        sequentially, and yields the same items as TextMelLoader.
+
+        Shards are assigned once (shuffled with `seed`) to slots of (rank, DataLoader worker);
+        every epoch each worker reads its shards in a new order and shuffles samples within a
+        buffer of `shuffle_buffer` samples. With fewer shards than slots, each shard is split
+        between several slots at the sample level (every slot still reads the whole file), so
+        no worker sits idle. Worker w yields the same number of samples on every rank, a
+        multiple of batch_size, so all ranks run the same number of steps; a warning is logged
+        if that drops much of the data. `num_workers` has to match the DataLoader.
+    """
+    def __init__(self, root, hparams, rank=0, num_replicas=1, num_workers=0, batch_size=1,
+                 shuffle_buffer=256, seed=1234, return_signal=False):
+        self.root = root
+        self.index = load_sample_shard_index(root)
+        self.features = self.index["features"]
+        self.rank = rank
+        self.num_replicas = num_replicas
+        self.num_workers = num_workers
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        self.epoch = 0
+        self._iterations = 0
+        self.return_signal = return_signal
+        self.add_noise = hparams.add_noise
+        self.max_wav_value = hparams.max_wav_value
+        self.mel_on_device = getattr(hparams, "mel_on_device", False)
+        if self.mel_on_device and (self.features == "mel" or return_signal):
+            raise ValueError("mel_on_device needs audio shards and can't be combined with return_signal "
+                             "(augmentation on the CPU)")
+        if self.index["params"] != mel_params(hparams):
+            if self.features == "mel" or self.index["params"]["sampling_rate"] != hparams.sampling_rate:
+                raise ValueError("Shards in {} were built with {}, expected {}".format(
+                    root, self.index["params"], mel_params(hparams)))
+        if self.features == "audio" and not self.mel_on_device:
+            self.stft = commons.TacotronSTFT(
+                hparams.filter_length, hparams.hop_length, hparams.win_length,
+                hparams.n_mel_channels, hparams.sampling_rate, hparams.mel_fmin,
+                hparams.mel_fmax)
+        if self.index["text_params"] != text_params(hparams):
+            logging.warning("Token ids in {} were built with another text config, running the text frontend instead".format(root))
+            self.text_cleaners = hparams.text_cleaners
+            self.add_blank = getattr(hparams, "add_blank", False)
+            self.cmudict = None
+            if getattr(hparams, "cmudict_path", None) is not None:
+                self.cmudict = cmudict.CMUDict(hparams.cmudict_path)
+
+        n_slots = num_replicas * max(1, num_workers)
+        # (shard, part, n_parts): the samples i of a shard with i % n_parts == part
+        n_parts = -(-n_slots // max(1, len(self.index["shards"])))
+        pieces = [(shard, part, n_parts) for shard in self.index["shards"] for part in range(n_parts)]
+        order = list(range(len(pieces)))
+        random.Random(seed).shuffle(order)
+        # slot_shards[r][w]: shard pieces read by worker w of rank r
+        self.slot_shards = [[[pieces[i] for i in order[w * num_replicas + r::n_slots]]
+                             for w in range(max(1, num_workers))] for r in range(num_replicas)]
+        self.worker_quotas = []
+        for w in range(max(1, num_workers)):
+            available = min(sum(len(range(part, shard["count"], n)) for shard, part, n in self.slot_shards[r][w])
+                            for r in range(num_replicas))
+            self.worker_quotas.append(available // batch_size * batch_size)
+        n_samples = sum(x["count"] for x in self.index["shards"])
+        if rank == 0 and n_samples - num_replicas * len(self) > 0.05 * n_samples:
+            logging.warning("{} of {} samples in {} are skipped every epoch to give all ranks and workers whole "
+                            "batches of the same number of samples, write more or smaller shards".format(
+                                n_samples - num_replicas * len(self), n_samples, root))
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __len__(self):
+        return sum(self.worker_quotas)
+
+    def get_item(self, sample):
+        if hasattr(self, "text_cleaners"):
+            text = text_to_sequence(sample["json"]["text"], self.text_cleaners, self.cmudict)
+            if self.add_blank:
+                text = commons.intersperse(text, len(symbols))
+            text = torch.IntTensor(text)
+        else:
+            text = torch.from_numpy(sample["tokens"].astype(np.int32))
+        if self.features == "mel":
+            melspec = torch.from_numpy(sample["mel"])
+            return (text, melspec, melspec) if self.return_signal else (text, melspec)
+        signal = torch.from_numpy(sample["audio"].astype(np.float32))
+        if self.add_noise:
+            signal = signal + torch.rand_like(signal)
+        signal = signal / self.max_wav_value
+        if self.mel_on_device:
+            return text, signal
+        with torch.no_grad():
+            melspec = self.stft.mel_spectrogram(signal.unsqueeze(0)).squeeze(0)
+        return (text, melspec, signal) if self.return_signal else (text, melspec)
+
+    def _samples(self, shards):
+        for shard, part, n_parts in shards:
+            for i, sample in enumerate(iter_sample_shard(os.path.join(self.root, shard["file"]))):
+                if i % n_parts == part:
+                    yield sample
+
+    def __iter__(self):
+        worker_info = torch.utils.data.get_worker_info()
+        num_workers = 0 if worker_info is None else worker_info.num_workers
+        if num_workers != self.num_workers:
+            raise ValueError("Dataset was split for {} workers, the DataLoader runs {}".format(
+                self.num_workers, num_workers))
+        worker_id = 0 if worker_info is None else worker_info.id
+        # persistent workers never see set_epoch, so their own iterations advance the epoch too
+        epoch = self.epoch + self._iterations
+        self._iterations += 1
+        rng = random.Random("{}-{}-{}-{}".format(self.seed, epoch, self.rank, worker_id))
+        shards = list(self.slot_shards[self.rank][worker_id])
+        rng.shuffle(shards)
+
+        quota = self.worker_quotas[worker_id]
+        n_yielded = 0
+        buffer = []
+        for sample in self._samples(shards):
+            if n_yielded == quota:
+                return
+            if len(buffer) < self.shuffle_buffer:
+                buffer.append(sample)
+                continue
+            i = rng.randrange(len(buffer))
+            sample, buffer[i] = buffer[i], sample
+            yield self.get_item(sample)
+            n_yielded += 1
+        rng.shuffle(buffer)
+        for sample in buffer[:quota - n_yielded]:
+            yield self.get_item(sample)
+
+
+def loader_worker_kwargs(hparams, num_workers=1):
+    """ DataLoader worker settings from the train config, `num_workers` if not configured """
+    num_workers = getattr(hparams, "num_workers", num_workers)
+    kwargs = {"num_workers": num_workers}
+    if num_workers > 0:
+        kwargs["prefetch_factor"] = getattr(hparams, "prefetch_factor", 2)
+        kwargs["persistent_workers"] = getattr(hparams, "persistent_workers", False)
+    return kwargs
+
+
+class PaddedBatchPacker():
+    """ Zero-pads (text, mel) or (text, signal) batches, optionally into reusable buffers
+
+        Every item is copied once and only its padding is zeroed, instead of zeroing the
+        whole batch first. By default every batch gets fresh tensors. With `n_buffers` > 0,
+        in the main process the outputs are written into a ring of `n_buffers` reusable
+        buffers (pinned if CUDA is available) instead, so a returned batch is overwritten
+        `n_buffers` batches later: only for consumers that are done with (or have copied)
+        a batch before then. Pinned batches are typically copied to the GPU with
+        non_blocking=True: an event is recorded on the current CUDA stream when the next
+        batch is packed, by which time the copies of the previous one have been queued, and
+        a buffer is only reused once its event has completed. In DataLoader workers, whose
+        outputs are moved to shared memory, fresh tensors are allocated regardless.
+    """
+    def __init__(self, n_buffers=0):
+        self.n_buffers = n_buffers
+        self._buffers = {}
+        self._events = {}
+        self._slot = 0
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_buffers"] = {}
+        state["_events"] = {}
+        return state
+
+    def _next_slot(self):
+        """ Moves to the next buffer slot, after pending device copies out of it have finished """
+        if self._buffers and torch.cuda.is_available():
+            # only set in the main process; the batch packed last has been handed out and copied
+            event = torch.cuda.Event()
+            event.record()
+            self._events[self._slot] = event
+        self._slot = (self._slot + 1) % self.n_buffers
+        event = self._events.pop(self._slot, None)
+        if event is not None:
+            event.synchronize()
+
+    def _empty(self, name, shape, dtype):
+        if self.n_buffers == 0 or torch.utils.data.get_worker_info() is not None:
+            return torch.empty(shape, dtype=dtype)
+        numel = int(np.prod(shape))
+        key = (name, self._slot)
+        buffer = self._buffers.get(key)
+        if buffer is None or buffer.numel() < numel or buffer.dtype != dtype:
+            # some headroom, so the buffer settles after a few long batches
+            buffer = torch.empty(numel + numel // 4, dtype=dtype)
+            if torch.cuda.is_available():
+                buffer = buffer.pin_memory()
+            self._buffers[key] = buffer
+        return buffer[:numel].view(shape)
+
+    @staticmethod
+    def _pad(out, tensors):
+        """ Writes tensors[i] ([..., length_i]) into out[i] ([..., max_len]) and zeros the rest """
+        for i, x in enumerate(tensors):
+            length = x.size(-1)
+            out[i, ..., :length] = x
+            out[i, ..., length:] = 0
+
+    def pack_text_mel(self, batch, n_frames_per_step=1):
+        """ batch: [text, mel, ...] (or a [T] signal instead of the mel); returns text_padded,
+            input_lengths, mel_padded, output_lengths, ids_sorted_decreasing (sorted by
+            decreasing text length)
+        """
+        if self.n_buffers > 0:
+            self._next_slot()
+
+        # Right zero-pad all one-hot text sequences to max input length
+        input_lengths, ids_sorted_decreasing = torch.sort(
+            torch.LongTensor([len(x[0]) for x in batch]),
+            dim=0, descending=True)
+        ids_sorted_decreasing = ids_sorted_decreasing.tolist()
+        texts = [batch[i][0] for i in ids_sorted_decreasing]
+        mels = [batch[i][1] for i in ids_sorted_decreasing]
+
+        text_padded = self._empty("text", (len(batch), int(input_lengths[0])), torch.long)
+        self._pad(text_padded, texts)
+
+        # Right zero-pad mel-spec
+        output_lengths = torch.LongTensor([mel.size(-1) for mel in mels])
+        max_target_len = int(output_lengths.max())
+        if max_target_len % n_frames_per_step != 0:
+            max_target_len += n_frames_per_step - max_target_len % n_frames_per_step
+            assert max_target_len % n_frames_per_step == 0
+
+        mel_padded = self._empty("mel", (len(batch), *mels[0].shape[:-1], max_target_len), torch.float)
+        self._pad(mel_padded, mels)
+
+        return text_padded, input_lengths, mel_padded, output_lengths, ids_sorted_decreasing
+
+
 class TextMelCollate():
     """ Zero-pads model inputs and targets based on number of frames per step
         add augmented samples to batch
+
+        Items are (text, mel) as returned by TextMelLoader, or (text, mel, signal) with
+        return_signal. The augmentor works on whole batches of signals, so it runs here, in
+        the batch stage; mels of the unmodified signals are taken from the items instead of
+        being computed again.
+
+        With return_ids, items end with their dataset index and batches with the indices in
+        batch order (-1 for all of them if the augmentor changed the batch size).
+
+        Batches are fresh tensors. With `n_buffers` > 0 and the collate running in the main
+        process (num_workers=0), they are views of a ring of reused (pinned) buffers instead,
+        valid until `n_buffers` further batches have been collated (see PaddedBatchPacker);
+        callers that keep a batch longer (prefetching, lookahead, logging) must copy it.
     """
-    def __init__(self, hparams, n_frames_per_step=1, augmentor=None):
+    def __init__(self, hparams, n_frames_per_step=1, augmentor=None, return_ids=False, n_buffers=0):
+        self.return_ids = return_ids
         if augmentor is not None:
             self.augmentor = augmentor.get(self.get_mel)
         else:
             self.augmentor = None
         self.n_frames_per_step = n_frames_per_step
+        self.packer = PaddedBatchPacker(n_buffers)
+        self._item_mels = {}
         self.load_mel_from_disk = hparams.load_mel_from_disk
+        self.mel_on_device = getattr(hparams, "mel_on_device", False)
+        if self.mel_on_device and self.augmentor is not None:
+            raise ValueError("The augmentor needs mels computed on CPU, disable mel_on_device")
         self.max_wav_value = hparams.max_wav_value
         self.sampling_rate = hparams.sampling_rate
         self.stft = commons.TacotronSTFT(
@@ -79,14 +462,18 @@ class TextMelCollate():
             hparams.mel_fmax)
 
     def get_mel(self, signal):
+        melspec = self._item_mels.get(id(signal))
+        if melspec is not None:
+            return melspec
+        if isinstance(signal, np.ndarray):
+            signal = torch.from_numpy(signal)
         if not self.load_mel_from_disk:
-            if isinstance(signal, np.ndarray):
-                signal = torch.from_numpy(signal)
             signal = signal.unsqueeze(0)
             melspec = self.stft.mel_spectrogram(signal)
             melspec = torch.squeeze(melspec, 0)
         else:
-            assert False, "load_mel_from_disk is not implemented"
+            # TextMelLoader already returns mel-spectrograms
+            melspec = signal
 
         return melspec
 
@@ -94,46 +481,185 @@ class TextMelCollate():
         """Collate's training batch from normalized text and mel-spectrogram
         PARAMS
         ------
-        batch: [text_normalized, signal]
+        batch: [text_normalized, mel_normalized(, signal)], or [text_normalized, signal]
+            with mel_on_device, which gives padded signals and their lengths in samples
         """
+        if self.return_ids:
+            item_ids = [x[-1] for x in batch]
+            batch = [x[:-1] for x in batch]
         if self.augmentor is not None:
             # augment the batch
             # no need for self.get_mel, augmenter will handle this
-            batch = self.augmentor.augment_batch(batch)
+            assert len(batch[0]) == 3, "Augmentation needs the signals, use TextMelLoader(..., return_signal=True)"
+            self._item_mels = {id(x[2]): x[1] for x in batch}
+            try:
+                batch = self.augmentor.augment_batch([[x[0], x[2]] for x in batch])
+            finally:
+                self._item_mels = {}
+
+        packed = self.packer.pack_text_mel(batch, 1 if self.mel_on_device else self.n_frames_per_step)
+        if not self.return_ids:
+            return packed[:4]
+        if len(batch) != len(item_ids):
+            ids = torch.full((len(batch),), -1, dtype=torch.long)
         else:
-            batch = [[t, self.get_mel(signal)] for t, signal in batch]
+            ids = torch.LongTensor([item_ids[i] for i in packed[4]])
+        return (*packed[:4], ids)
 
 
-        # Right zero-pad all one-hot text sequences to max input length
-        input_lengths, ids_sorted_decreasing = torch.sort(
-            torch.LongTensor([len(x[0]) for x in batch]),
-            dim=0, descending=True)
-        max_input_len = input_lengths[0]
-
-        text_padded = torch.LongTensor(len(batch), max_input_len)
-        text_padded.zero_()
-        for i in range(len(ids_sorted_decreasing)):
-            text = batch[ids_sorted_decreasing[i]][0]
-            text_padded[i, :text.size(0)] = text
-
+class DistributedBucketSampler(torch.utils.data.distributed.DistributedSampler):
+    """
+    Maintain similar mel lengths in a batch.
+    Length groups are specified by boundaries.
+    Ex) boundaries = [b1, b2, b3] -> any batch is included either {x | b1 < length(x) <= b2} or {x | b2 < length(x) <= b3}.
+    Utterances shorter than b1 join the first group and utterances longer than b3 the last one.
+
+    Every epoch, buckets are shuffled internally and the resulting batches are shuffled across buckets.
+    Neighbouring utterances of a bucket go to different ranks, so all ranks see batches of similar frame counts.
+
+    With max_frames, batches hold as many utterances as fit a per-rank frame budget instead of
+    batch_size of them: max(length) * count <= max_frames ("max", the padded size) or
+    sum(length) <= max_frames ("sum"). batch_size then only serves as the reference batch of the
+    learning rate schedule, see step_scale.
+    """
+    def __init__(self, dataset, batch_size, boundaries, num_replicas=None, rank=None, shuffle=True, seed=0,
+                 max_frames=None, frame_budget="max"):
+        super().__init__(dataset, num_replicas=num_replicas, rank=rank, shuffle=shuffle, seed=seed)
+        assert frame_budget in ("max", "sum"), "Unknown frame budget {}".format(frame_budget)
+        self.lengths = dataset.get_lengths()
+        self.batch_size = batch_size
+        self.boundaries = boundaries
+        self.max_frames = max_frames
+        self.frame_budget = frame_budget
+
+        self.buckets, self.num_samples_per_bucket = self._create_buckets()
+        self.total_size = sum(self.num_samples_per_bucket)
+        self.num_samples = self.total_size // self.num_replicas
+        self._batches_epoch = None
+
+    def _create_buckets(self):
+        buckets = [[] for _ in range(len(self.boundaries) - 1)]
+        for i in range(len(self.lengths)):
+            idx_bucket = self._bisect(self.lengths[i])
+            buckets[idx_bucket].append(i)
+
+        buckets = [bucket for bucket in buckets if len(bucket) > 0]
+
+        # with a fixed batch size, every bucket is padded to a multiple of the global batch size
+        num_samples_per_bucket = []
+        total_batch_size = self.num_replicas * self.batch_size
+        for bucket in buckets:
+            len_bucket = len(bucket)
+            if self.max_frames is None:
+                rem = (total_batch_size - (len_bucket % total_batch_size)) % total_batch_size
+            else:
+                rem = 0
+            num_samples_per_bucket.append(len_bucket + rem)
+        return buckets, num_samples_per_bucket
+
+    def _bisect(self, x):
+        lo, hi = 0, len(self.boundaries) - 1
+        while hi - lo > 1:
+            mid = (lo + hi) // 2
+            if x > self.boundaries[mid]:
+                lo = mid
+            else:
+                hi = mid
+        return lo
+
+    def _fixed_size_groups(self, bucket, ids_bucket, num_samples_bucket):
+        # add extra samples to make it evenly divisible
+        len_bucket = len(bucket)
+        rem = num_samples_bucket - len_bucket
+        ids_bucket = ids_bucket + ids_bucket * (rem // len_bucket) + ids_bucket[:(rem % len_bucket)]
+
+        total_batch_size = self.num_replicas * self.batch_size
+        groups = []
+        for j in range(len(ids_bucket) // total_batch_size):
+            groups.append([bucket[idx] for idx in ids_bucket[j*total_batch_size:(j+1)*total_batch_size]])
+        return groups
+
+    def _frame_budget_groups(self, bucket, ids_bucket):
+        """Greedily grows global batches while every rank's share stays within max_frames."""
+        # utterances are dealt in rounds of one per rank, so all ranks get the same number of batches
+        rem = (self.num_replicas - len(ids_bucket) % self.num_replicas) % self.num_replicas
+        ids_bucket = ids_bucket + [ids_bucket[i % len(ids_bucket)] for i in range(rem)]
+
+        groups = []
+        group, max_lens, sum_lens, n_rounds = [], [0] * self.num_replicas, [0] * self.num_replicas, 0
+        for j in range(0, len(ids_bucket), self.num_replicas):
+            ids_round = [bucket[idx] for idx in ids_bucket[j:j+self.num_replicas]]
+            lens_round = [self.lengths[i] for i in ids_round]
+            if self.frame_budget == "max":
+                fits = all(max(m, l) * (n_rounds + 1) <= self.max_frames for m, l in zip(max_lens, lens_round))
+            else:
+                fits = all(s + l <= self.max_frames for s, l in zip(sum_lens, lens_round))
+            if n_rounds > 0 and not fits:
+                groups.append(group)
+                group, max_lens, sum_lens, n_rounds = [], [0] * self.num_replicas, [0] * self.num_replicas, 0
+            group += ids_round
+            max_lens = [max(m, l) for m, l in zip(max_lens, lens_round)]
+            sum_lens = [s + l for s, l in zip(sum_lens, lens_round)]
+            n_rounds += 1
+        if len(group) > 0:
+            groups.append(group)
+        return groups
+
+    def _get_groups(self):
+        """Global batches of the current epoch; rank r takes group[r::num_replicas] of each."""
+        if self._batches_epoch == self.epoch:
+            return self.groups
+
+        # deterministically shuffle based on seed and epoch, identically on all ranks
+        g = torch.Generator()
+        g.manual_seed(self.seed + self.epoch)
+
+        indices = []
+        if self.shuffle:
+            for bucket in self.buckets:
+                indices.append(torch.randperm(len(bucket), generator=g).tolist())
+        else:
+            for bucket in self.buckets:
+                indices.append(list(range(len(bucket))))
+
+        groups = []
+        for i in range(len(self.buckets)):
+            if self.max_frames is None:
+                groups += self._fixed_size_groups(self.buckets[i], indices[i], self.num_samples_per_bucket[i])
+            else:
+                groups += self._frame_budget_groups(self.buckets[i], indices[i])
+
+        if self.shuffle:
+            group_ids = torch.randperm(len(groups), generator=g).tolist()
+            groups = [groups[i] for i in group_ids]
+
+        self.groups = groups
+        self._batches_epoch = self.epoch
+        return self.groups
+
+    def __iter__(self):
+        # subsample
+        batches = [group[self.rank::self.num_replicas] for group in self._get_groups()]
+        if self.max_frames is None:
+            assert len(batches) * self.batch_size == self.num_samples
+        return iter(batches)
 
-        # Right zero-pad mel-spec
-        max_target_len = max([x[1].size(1) for x in batch])
-        if max_target_len % self.n_frames_per_step != 0:
-            max_target_len += self.n_frames_per_step - max_target_len % self.n_frames_per_step
-            assert max_target_len % self.n_frames_per_step == 0
+    def __len__(self):
+        if self.max_frames is None:
+            return self.num_samples // self.batch_size
+        return len(self._get_groups())
 
-        # include mel padded
-        num_mels = batch[0][1].size(0)
-        mel_padded = torch.FloatTensor(len(batch), num_mels, max_target_len)
-        mel_padded.zero_()
-        output_lengths = torch.LongTensor(len(batch))
-        for i in range(len(ids_sorted_decreasing)):
-            mel = batch[ids_sorted_decreasing[i]][1]
-            mel_padded[i, :, :mel.size(1)] = mel
-            output_lengths[i] = mel.size(1)
+    def step_scale(self, batch_idx):
+        """Size of the global batch batch_idx relative to num_replicas * batch_size."""
+        if self.max_frames is None:
+            return 1
+        return len(self._get_groups()[batch_idx]) / (self.num_replicas * self.batch_size)
 
-        return text_padded, input_lengths, mel_padded, output_lengths
+    def reference_steps_per_epoch(self):
+        """Length of an epoch in steps of num_replicas * batch_size utterances."""
+        if self.max_frames is None:
+            return len(self)
+        return self.total_size / (self.num_replicas * self.batch_size)
 
 
 """Multi speaker version"""
@@ -159,10 +685,13 @@ class TextMelSpeakerLoader(torch.utils.data.Dataset):
             hparams.filter_length, hparams.hop_length, hparams.win_length,
             hparams.n_mel_channels, hparams.sampling_rate, hparams.mel_fmin,
             hparams.mel_fmax)
+        if not self.load_mel_from_disk:
+            wav_num_samples(audiopaths_sid_text, self.sampling_rate)
 
         self._filter_text_len()
+        self.audiopaths_sid_text = PackedFilelist(self.audiopaths_sid_text)
         random.seed(1234)
-        random.shuffle(self.audiopaths_sid_text)
+        self.audiopaths_sid_text.shuffle(random)
 
     def _filter_text_len(self):
       audiopaths_sid_text_new = []
@@ -222,6 +751,7 @@ class TextMelSpeakerCollate():
     """
     def __init__(self, n_frames_per_step=1):
         self.n_frames_per_step = n_frames_per_step
+        self.packer = PaddedBatchPacker()
 
     def __call__(self, batch):
         """Collate's training batch from normalized text and mel-spectrogram
@@ -229,34 +759,8 @@ class TextMelSpeakerCollate():
         ------
         batch: [text_normalized, mel_normalized]
         """
-        # Right zero-pad all one-hot text sequences to max input length
-        input_lengths, ids_sorted_decreasing = torch.sort(
-            torch.LongTensor([len(x[0]) for x in batch]),
-            dim=0, descending=True)
-        max_input_len = input_lengths[0]
-
-        text_padded = torch.LongTensor(len(batch), max_input_len)
-        text_padded.zero_()
-        for i in range(len(ids_sorted_decreasing)):
-            text = batch[ids_sorted_decreasing[i]][0]
-            text_padded[i, :text.size(0)] = text
-
-        # Right zero-pad mel-spec
-        num_mels = batch[0][1].size(0)
-        max_target_len = max([x[1].size(1) for x in batch])
-        if max_target_len % self.n_frames_per_step != 0:
-            max_target_len += self.n_frames_per_step - max_target_len % self.n_frames_per_step
-            assert max_target_len % self.n_frames_per_step == 0
-
-        # include mel padded & sid
-        mel_padded = torch.FloatTensor(len(batch), num_mels, max_target_len)
-        mel_padded.zero_()
-        output_lengths = torch.LongTensor(len(batch))
-        sid = torch.LongTensor(len(batch))
-        for i in range(len(ids_sorted_decreasing)):
-            mel = batch[ids_sorted_decreasing[i]][1]
-            mel_padded[i, :, :mel.size(1)] = mel
-            output_lengths[i] = mel.size(1)
-            sid[i] = batch[ids_sorted_decreasing[i]][2]
+        text_padded, input_lengths, mel_padded, output_lengths, ids_sorted_decreasing = \
+            self.packer.pack_text_mel(batch, self.n_frames_per_step)
+        sid = torch.LongTensor([int(batch[i][2]) for i in ids_sorted_decreasing])
 
         return text_padded, input_lengths, mel_padded, output_lengths, sid
@@ -0,0 +1,847 @@
+""" Sharded, memory-mapped storage for precomputed features.
+
+A store is a directory holding
+  meta.json        dtype, per-row shape and the parameters the features were built with
+  index.npz        key -> (shard, offset, length), and a copy of the meta
+  index.rebuild.npz  the same for a rebuild in progress, until it replaces index.npz
+  shard_xxxxx.bin  raw, contiguous arrays of [length, *row_shape] items
+
+Items are read back as zero-copy views into the memory-mapped shards.
+
+FeatureCache (mels, on local disk) and SharedAudioCache (decoded audio, in shared memory) are
+node-local caches that fill up as training runs, shared by all processes and runs on a machine,
+for filelists that change too often to build a store for each of them.
+
+For streaming from storage without random access, build_sample_shards writes whole
+training samples into tar shards that are only ever read sequentially.
+"""
+import io
+import os
+import json
+import fcntl
+import random
+import hashlib
+import logging
+import tarfile
+import time
+import multiprocessing
+import numpy as np
+import torch
+from scipy.io.wavfile import read
+
+from utils import load_wav_to_torch, load_filepaths_and_text
+
+
+META_FILE = "meta.json"
+INDEX_FILE = "index.npz"
+STAGING_INDEX_FILE = "index.rebuild.npz"
+SHARD_FILE = "shard_{:05d}.bin"
+MAX_SHARD_BYTES = 1 << 30
+MIN_LIVE_FRACTION = 0.5
+TMP_FILE_TIMEOUT = 3600  # seconds after which a cache file still being written counts as abandoned
+
+
+class ShardedArrayWriter():
+  """Appends variable-length arrays to fixed-size shards and writes their index on close.
+
+  With append=True the entries of an existing store are kept, new shards are added after its
+  last one and re-added keys replace their old entries; otherwise the store is rebuilt.
+  commit() makes everything added so far visible to readers, so an interrupted update can
+  resume from its last commit. A rebuild only becomes visible on close, all at once: until
+  then readers keep getting the previous store, and commit() writes a staging index instead,
+  which a rebuild with resume=True and the same meta continues from.
+
+  Shards are never modified once written. On close, shards whose live entries (those still in
+  the index) fill less than `min_live_fraction` of them are compacted: their live entries are
+  copied to new shards and the old files are removed once the new index is in place. Readers
+  keep the shards they were opened with open, so removing them doesn't disturb running jobs.
+  Each entry can carry a stamp (e.g. mtime and size of its source) for later updates to
+  detect stale entries.
+  """
+  def __init__(self, root, dtype, row_shape=(), meta=None, max_shard_bytes=MAX_SHARD_BYTES, append=False,
+               min_live_fraction=MIN_LIVE_FRACTION, resume=False):
+    self.root = root
+    self.dtype = np.dtype(dtype)
+    self.row_shape = tuple(row_shape)
+    self.meta = meta or {}
+    self.max_shard_bytes = max_shard_bytes
+    self.append = append
+    self.min_live_fraction = min_live_fraction
+    os.makedirs(root, exist_ok=True)
+
+    self._entries = {}  # key -> (shard, offset, length, stamp)
+    self._shard_file = None
+    self._shard_rows = 0
+    self._shard_bytes = 0
+    # new shards always get new ids, the shards of the current store stay untouched
+    self._shard_id = max(_shard_ids(root), default=-1)
+    if append:
+      self._load_index(INDEX_FILE)
+    elif resume:
+      self._load_index(STAGING_INDEX_FILE)
+
+  def _load_index(self, name):
+    index_path = os.path.join(self.root, name)
+    if not os.path.isfile(index_path):
+      return
+    with np.load(index_path) as index:
+      meta = _index_meta(self.root, index)
+      if name == STAGING_INDEX_FILE:
+        # only a rebuild of the same kind is continued, whose shards are all still there
+        if any(meta.get(k) != v for k, v in self.meta.items()) or not all(
+            os.path.isfile(os.path.join(self.root, SHARD_FILE.format(i))) for i in np.unique(index["shards"]).tolist()):
+          return
+        logging.info("Resuming the rebuild of {} from {} entries".format(self.root, len(index["keys"])))
+      if np.dtype(meta["dtype"]) != self.dtype or tuple(meta["row_shape"]) != self.row_shape:
+        raise ValueError("Can't append {} {} rows to store {} of {} {} rows".format(
+          self.dtype, self.row_shape, self.root, meta["dtype"], tuple(meta["row_shape"])))
+      n = len(index["keys"])
+      stamps = index["stamps"] if "stamps" in index.files else np.full((n, 2), -1, dtype=np.int64)
+      for key, shard, offset, length, stamp in zip(index["keys"].tolist(), index["shards"].tolist(),
+          index["offsets"].tolist(), index["lengths"].tolist(), stamps.tolist()):
+        self._entries[key] = (shard, offset, length, tuple(stamp))
+
+  def stamp_of(self, key):
+    """The stamp `key` was added with, None if it is not in the store."""
+    entry = self._entries.get(key)
+    return None if entry is None else entry[3]
+
+  def _next_shard(self):
+    if self._shard_file is not None:
+      self._shard_file.close()
+    self._shard_id += 1
+    self._shard_file = open(os.path.join(self.root, SHARD_FILE.format(self._shard_id)), "wb")
+    self._shard_rows = 0
+    self._shard_bytes = 0
+
+  def add(self, key, array, stamp=(-1, -1)):
+    array = np.ascontiguousarray(array, dtype=self.dtype)
+    assert array.shape[1:] == self.row_shape, (
+      "Row shape mismatch: given {}, expected {}".format(array.shape[1:], self.row_shape))
+    if self._shard_file is None or (self._shard_bytes > 0 and self._shard_bytes + array.nbytes > self.max_shard_bytes):
+      self._next_shard()
+    self._shard_file.write(array.tobytes())
+    self._entries[key] = (self._shard_id, self._shard_rows, array.shape[0], tuple(stamp))
+    self._shard_rows += array.shape[0]
+    self._shard_bytes += array.nbytes
+
+  def commit(self):
+    """Flushes the shards and publishes the index, or stages it while the store is rebuilt."""
+    if self._shard_file is not None:
+      self._shard_file.flush()
+    self._write_index(INDEX_FILE if self.append else STAGING_INDEX_FILE)
+
+  def _write_index(self, name=INDEX_FILE):
+    meta = dict(self.meta)
+    meta.update({"dtype": self.dtype.str, "row_shape": list(self.row_shape)})
+    # the index is replaced atomically and carries the meta itself, so readers never see
+    # entries and parameters of different builds
+    entries = list(self._entries.values())
+    index_path = os.path.join(self.root, name)
+    tmp_path = index_path + ".tmp.npz"
+    np.savez(tmp_path,
+      keys=np.array(list(self._entries.keys()), dtype=np.str_),
+      shards=np.array([x[0] for x in entries], dtype=np.int32),
+      offsets=np.array([x[1] for x in entries], dtype=np.int64),
+      lengths=np.array([x[2] for x in entries], dtype=np.int64),
+      stamps=np.array([x[3] for x in entries], dtype=np.int64).reshape(-1, 2),
+      meta=np.array(json.dumps(meta)))
+    os.replace(tmp_path, index_path)
+    if name == INDEX_FILE:
+      # for reading only, after the index (indices without a meta of their own read it)
+      with open(os.path.join(self.root, META_FILE), "w") as f:
+        json.dump(meta, f, indent=2)
+
+  def _compact(self):
+    """Copies the live entries of mostly dead shards to new shards; returns the ids of the
+    shards that are no longer referenced, which includes every old shard of a rebuild.
+    """
+    row_bytes = self.dtype.itemsize * int(np.prod(self.row_shape, dtype=np.int64))
+    live = {}
+    for key, (shard, offset, length, stamp) in self._entries.items():
+      live.setdefault(shard, []).append((offset, length, key, stamp))
+    current = self._shard_id if self._shard_file is not None else None
+    stale = []
+    for shard_id in _shard_ids(self.root):
+      if shard_id == current:
+        continue
+      path = os.path.join(self.root, SHARD_FILE.format(shard_id))
+      live_bytes = row_bytes * sum(x[1] for x in live.get(shard_id, []))
+      if live_bytes == 0 or live_bytes < self.min_live_fraction * os.path.getsize(path):
+        stale.append(shard_id)
+    for shard_id in stale:
+      entries = sorted(live.get(shard_id, []))
+      if len(entries) == 0:
+        continue
+      path = os.path.join(self.root, SHARD_FILE.format(shard_id))
+      n_rows = max(offset + length for offset, length, _, _ in entries)
+      rows = np.memmap(path, dtype=self.dtype, mode="r", shape=(n_rows, *self.row_shape))
+      for offset, length, key, stamp in entries:
+        self.add(key, rows[offset:offset + length], stamp)
+      del rows
+    if len(stale) > 0:
+      logging.info("Compacted {} shards of {}".format(len(stale), self.root))
+    return stale
+
+  def close(self):
+    stale = self._compact()
+    if self._shard_file is not None:
+      self._shard_file.close()
+      self._shard_file = None
+    self._write_index()
+    # a staged rebuild is either complete now or was superseded by this update
+    if os.path.exists(os.path.join(self.root, STAGING_INDEX_FILE)):
+      os.remove(os.path.join(self.root, STAGING_INDEX_FILE))
+    for shard_id in stale:
+      os.remove(os.path.join(self.root, SHARD_FILE.format(shard_id)))
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, *args):
+    if exc_type is None:
+      self.close()
+      return
+    # interrupted: keep what was added for a re-run to resume from, an unfinished rebuild
+    # stays staged
+    self.commit()
+    if self._shard_file is not None:
+      self._shard_file.close()
+      self._shard_file = None
+
+
+def _shard_ids(root):
+  return sorted(int(name[len("shard_"):-len(".bin")]) for name in os.listdir(root)
+                if name.startswith("shard_") and name.endswith(".bin"))
+
+
+def _index_meta(root, index):
+  """The meta of the store at `root` with the loaded `index`; older indices don't carry it."""
+  if "meta" in index.files:
+    return json.loads(str(index["meta"]))
+  with open(os.path.join(root, META_FILE)) as f:
+    return json.load(f)
+
+
+class ShardedArrayReader():
+  """Random access to a store written by ShardedArrayWriter.
+
+  Keys are kept utf-8 encoded in one sorted numpy array and looked up by binary search, like
+  PackedFilelist, so forked DataLoader workers don't copy a Python object per entry.
+  """
+  def __init__(self, root):
+    self.root = root
+    try:
+      self._open()
+    except FileNotFoundError:
+      # an update replaced the index and removed shards in between, the new index is complete
+      self._open()
+
+  def _open(self):
+    index_path = os.path.join(self.root, INDEX_FILE)
+    if not os.path.isfile(index_path):
+      raise FileNotFoundError("{} is not a complete feature store (no {})".format(self.root, INDEX_FILE))
+    with np.load(index_path) as index:
+      self.meta = _index_meta(self.root, index)
+      keys = np.char.encode(index["keys"], "utf-8")
+      order = np.argsort(keys, kind="stable")
+      self.keys = keys[order]
+      self.shards = index["shards"][order]
+      self.offsets = index["offsets"][order]
+      self.lengths = index["lengths"][order]
+    self.dtype = np.dtype(self.meta["dtype"])
+    self.row_shape = tuple(self.meta["row_shape"])
+    # shard files are opened right away and mapped on first use: updates of the store may
+    # remove shards this index refers to, open files stay readable
+    self._files = {shard_id: open(os.path.join(self.root, SHARD_FILE.format(shard_id)), "rb")
+                   for shard_id in np.unique(self.shards).tolist()}
+    self._mmaps = {}
+
+  def __getstate__(self):
+    state = self.__dict__.copy()
+    del state["_files"], state["_mmaps"]
+    return state
+
+  def __setstate__(self, state):
+    self.__dict__.update(state)
+    self._open()
+
+  def __len__(self):
+    return len(self.keys)
+
+  def _find(self, key):
+    """Position of `key` in the sorted index, -1 if it is not in the store."""
+    encoded = key.encode("utf-8")
+    i = int(np.searchsorted(self.keys, encoded))
+    if i < len(self.keys) and self.keys[i] == encoded:
+      return i
+    return -1
+
+  def __contains__(self, key):
+    return self._find(key) >= 0
+
+  def index_of(self, key):
+    i = self._find(key)
+    if i < 0:
+      raise KeyError(key)
+    return i
+
+  def _shard(self, shard_id):
+    mmap = self._mmaps.get(shard_id)
+    if mmap is None:
+      f = self._files[shard_id]
+      row_size = int(np.prod(self.row_shape, dtype=np.int64))
+      n_rows = os.fstat(f.fileno()).st_size // (self.dtype.itemsize * row_size)
+      # copy-on-write keeps the views writable (torch requires it) without touching the file
+      mmap = np.memmap(f, dtype=self.dtype, mode="c", shape=(n_rows, *self.row_shape))
+      self._mmaps[shard_id] = mmap
+    return mmap
+
+  def get_by_id(self, i):
+    offset = self.offsets[i]
+    return self._shard(int(self.shards[i]))[offset:offset + self.lengths[i]]
+
+  def get(self, key):
+    return self.get_by_id(self.index_of(key))
+
+
+def params_key(params):
+  return hashlib.sha1(json.dumps(params, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+
+
+def mel_params(hparams):
+  """STFT/mel parameters a mel store has to agree with."""
+  return {
+    "max_wav_value": float(hparams.max_wav_value),
+    "sampling_rate": int(hparams.sampling_rate),
+    "filter_length": int(hparams.filter_length),
+    "hop_length": int(hparams.hop_length),
+    "win_length": int(hparams.win_length),
+    "n_mel_channels": int(hparams.n_mel_channels),
+    "mel_fmin": float(hparams.mel_fmin),
+    "mel_fmax": float(hparams.mel_fmax) if hparams.mel_fmax is not None else None,
+  }
+
+
+class MelStore(ShardedArrayReader):
+  """Mel-spectrograms keyed by the audio path used in the filelists."""
+  def __init__(self, root, hparams=None):
+    super().__init__(root)
+    if hparams is not None and self.meta.get("params") != mel_params(hparams):
+      raise ValueError("Mel store {} was built with {}, expected {}".format(
+        root, self.meta.get("params"), mel_params(hparams)))
+
+  def get_mel(self, audiopath):
+    """Returns a [n_mel_channels, T] view into the store."""
+    return torch.from_numpy(self.get(audiopath)).t()
+
+
+class SharedCounters():
+  """int64 counters in a small file, updated under a lock by any number of processes."""
+  def __init__(self, path, n):
+    self.path = path
+    self.n = n
+    if not os.path.exists(path):
+      tmp_path = "{}.{}.tmp".format(path, os.getpid())
+      with open(tmp_path, "wb") as f:
+        f.write(bytes(8 * n))
+      try:
+        os.link(tmp_path, path)  # never replaces counters another process created
+      except FileExistsError:
+        pass
+      os.remove(tmp_path)
+    self._fd = None
+    self._pid = None
+
+  def __getstate__(self):
+    state = self.__dict__.copy()
+    state["_fd"] = None
+    return state
+
+  def _file(self):
+    if self._fd is None or self._pid != os.getpid():
+      self._fd = os.open(self.path, os.O_RDWR)
+      self._pid = os.getpid()
+    return self._fd
+
+  def add(self, i, value=1):
+    fd = self._file()
+    fcntl.flock(fd, fcntl.LOCK_EX)
+    try:
+      count = int(np.frombuffer(os.pread(fd, 8, 8 * i), dtype=np.int64)[0])
+      os.pwrite(fd, np.int64(count + value).tobytes(), 8 * i)
+    finally:
+      fcntl.flock(fd, fcntl.LOCK_UN)
+
+  def values(self):
+    fd = self._file()
+    fcntl.flock(fd, fcntl.LOCK_SH)
+    try:
+      return np.frombuffer(os.pread(fd, 8 * self.n, 0), dtype=np.int64).tolist()
+    finally:
+      fcntl.flock(fd, fcntl.LOCK_UN)
+
+
+class FileLRUCache():
+  """Arrays computed on the fly, shared by all processes and runs on a node through `root`.
+
+  Entries are raw `dtype` arrays of shape [*leading_shape, T] in <root>/xx/<key>.bin, keyed by
+  the real path, mtime and size of the source file, so edited files are never served stale. Writes are atomic (tmp file + rename), hits
+  refresh the entry's mtime, and once the cache grows past about `max_bytes` the least
+  recently used entries are evicted. Hits and misses are counted across all processes.
+  """
+  def __init__(self, root, max_bytes, dtype=np.float32, leading_shape=(), mmap=False):
+    self.root = root
+    self.max_bytes = max_bytes
+    self.dtype = np.dtype(dtype)
+    self.leading_shape = tuple(leading_shape)
+    self.mmap = mmap
+    self._written = 0
+    os.makedirs(self.root, exist_ok=True)
+    self.counters = SharedCounters(os.path.join(self.root, "counters.bin"), 2)
+
+  def stats(self):
+    hits, misses = self.counters.values()
+    return {"hits": hits, "misses": misses, "hit_rate": hits / max(hits + misses, 1)}
+
+  def _entry_path(self, path):
+    stat = os.stat(path)
+    key = hashlib.sha1("{}\0{}\0{}".format(
+      os.path.realpath(path), stat.st_mtime_ns, stat.st_size).encode("utf-8")).hexdigest()
+    return os.path.join(self.root, key[:2], key + ".bin")
+
+  def get(self, path, compute):
+    """Returns the cached array for `path`, or the tensor `compute(path)` cached on a miss."""
+    entry_path = self._entry_path(path)
+    try:
+      if self.mmap:
+        # copy-on-write keeps the views writable (torch requires it) without touching the file
+        array = np.memmap(entry_path, dtype=self.dtype, mode="c")
+      else:
+        array = np.fromfile(entry_path, dtype=self.dtype)
+      array = array.reshape(*self.leading_shape, -1)
+      os.utime(entry_path)
+      self.counters.add(0)
+      return torch.from_numpy(array)
+    except (OSError, ValueError):
+      pass  # missing, or evicted by another process in between
+    self.counters.add(1)
+    tensor = compute(path)
+    self._put(entry_path, tensor.numpy().astype(self.dtype, copy=False))
+    return tensor
+
+  def _put(self, path, array):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    array.tofile(tmp_path)
+    os.replace(tmp_path, path)
+    self._written += array.nbytes
+    if self._written > self.max_bytes // 16:
+      self._written = 0
+      self.evict()
+
+  def evict(self):
+    """Removes least recently used entries until the cache is below 90% of `max_bytes`.
+    Skipped if another process is already evicting. Files other processes are still writing
+    (*.tmp) are left alone, unless they are an hour old and so left over from a crash.
+    """
+    with open(os.path.join(self.root, "evict.lock"), "w") as lock:
+      try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+      except BlockingIOError:
+        return
+      entries = []
+      abandoned_before = time.time_ns() - TMP_FILE_TIMEOUT * 10**9
+      for subdir in os.scandir(self.root):
+        if subdir.is_dir():
+          for entry in os.scandir(subdir.path):
+            try:
+              stat = entry.stat()
+            except FileNotFoundError:
+              continue
+            if entry.name.endswith(".tmp") and stat.st_mtime_ns > abandoned_before:
+              continue
+            entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+      total = sum(x[1] for x in entries)
+      entries.sort()
+      for _, size, path in entries:
+        if total <= self.max_bytes * 0.9:
+          break
+        try:
+          os.remove(path)
+        except FileNotFoundError:
+          pass
+        total -= size
+
+
+class FeatureCache(FileLRUCache):
+  """Mels computed on the fly, under <root>/<hash of the mel parameters>. Like the mel store,
+  cached mels are computed without dequantization noise (`add_noise`).
+  """
+  def __init__(self, root, hparams, max_bytes):
+    super().__init__(os.path.join(root, params_key(mel_params(hparams))), max_bytes,
+        leading_shape=(hparams.n_mel_channels,))
+
+  def get_mel(self, audiopath, extract):
+    """Returns the [n_mel_channels, T] mel of `audiopath`, computed by `extract(audiopath)` on a miss."""
+    return self.get(audiopath, extract)
+
+
+class SharedAudioCache(FileLRUCache):
+  """Decoded audio in RAM, shared by all DataLoader workers and DDP ranks on a node.
+
+  `root` should be on a tmpfs such as /dev/shm (POSIX shared memory on Linux). Hits are
+  memory-mapped copy-on-write, so reading a cached waveform copies nothing. Only audio at
+  `sampling_rate` is cached.
+  """
+  def __init__(self, root, sampling_rate, max_bytes):
+    super().__init__(os.path.join(root, str(sampling_rate)), max_bytes, mmap=True)
+    self.sampling_rate = sampling_rate
+
+  def get_audio(self, audiopath, load=load_wav_to_torch):
+    """Same as `load(audiopath)`, (float32 signal, sampling rate)."""
+    def load_matching(path):
+      audio, sampling_rate = load(path)
+      if sampling_rate != self.sampling_rate:
+        raise ValueError("{} {} SR doesn't match target {} SR".format(
+          path, sampling_rate, self.sampling_rate))
+      return audio
+    return self.get(audiopath, load_matching), self.sampling_rate
+
+
+def _mel_extractor(hparams):
+  """Returns audiopath -> [T, n_mel_channels] float32 mel, computed like TextMelLoader does."""
+  import commons
+  stft = commons.TacotronSTFT(
+      hparams.filter_length, hparams.hop_length, hparams.win_length,
+      hparams.n_mel_channels, hparams.sampling_rate, hparams.mel_fmin,
+      hparams.mel_fmax)
+
+  def extract(audiopath):
+    audio, sampling_rate = load_wav_to_torch(audiopath)
+    if sampling_rate != hparams.sampling_rate:
+      raise ValueError("{} {} SR doesn't match target {} SR".format(
+        audiopath, sampling_rate, hparams.sampling_rate))
+    audio_norm = (audio / hparams.max_wav_value).unsqueeze(0)
+    with torch.no_grad():
+      melspec = stft.mel_spectrogram(audio_norm).squeeze(0)
+    return melspec.t().numpy()
+  return extract
+
+
+def _unique_paths(filelists):
+  audiopaths_and_text = []
+  seen = set()
+  for filelist in filelists:
+    for audiopath_and_text in load_filepaths_and_text(filelist):
+      if audiopath_and_text[0] not in seen:
+        seen.add(audiopath_and_text[0])
+        audiopaths_and_text.append(audiopath_and_text)
+  return audiopaths_and_text
+
+
+def build_mel_store(filelists, out_dir, hparams, max_shard_bytes=MAX_SHARD_BYTES):
+  """Computes mels for every audio file in `filelists` with the exact TacotronSTFT of `hparams`.
+  Dequantization noise (`add_noise`) is not applied to stored features.
+  """
+  extract = _mel_extractor(hparams)
+  audiopaths = [x[0] for x in _unique_paths(filelists)]
+
+  meta = {"kind": "mel", "params": mel_params(hparams)}
+  with ShardedArrayWriter(out_dir, np.float32, (hparams.n_mel_channels,), meta, max_shard_bytes) as writer:
+    for audiopath in audiopaths:
+      writer.add(audiopath, extract(audiopath))
+  return len(audiopaths)
+
+
+_worker_extract = None
+
+
+def _init_mel_worker(hparams):
+  global _worker_extract
+  torch.set_num_threads(1)
+  _worker_extract = _mel_extractor(hparams)
+
+
+def _extract_mel_in_worker(audiopath):
+  return _worker_extract(audiopath)
+
+
+def _source_stamp(path):
+  stat = os.stat(path)
+  return (stat.st_mtime_ns, stat.st_size)
+
+
+def _store_params(root):
+  """The params a store was built with, None if there is no complete store at `root`."""
+  if not os.path.isfile(os.path.join(root, INDEX_FILE)):
+    return None
+  with np.load(os.path.join(root, INDEX_FILE)) as index:
+    return _index_meta(root, index).get("params")
+
+
+def update_mel_store(filelists, out_dir, hparams, num_workers=1, chunk_size=256, max_shard_bytes=MAX_SHARD_BYTES):
+  """Like build_mel_store, but only computes mels that are missing from the store at `out_dir`
+  or whose audio changed (mtime or size) since. Changed mel parameters rebuild the store,
+  which replaces the old one once complete. Progress is committed (staged, for a rebuild)
+  every `chunk_size` mels, so an interrupted update or rebuild can be re-run to resume. Entries of files that are no longer in
+  `filelists` are kept; replaced entries are dropped as their shards get compacted.
+  Returns (number of mels computed, number of audio files).
+  """
+  meta = {"kind": "mel", "params": mel_params(hparams)}
+  params = _store_params(out_dir)
+  append = params == meta["params"]
+  if params is not None and not append:
+    logging.info("Mel parameters of {} changed, rebuilding it (readers keep the old store until it is done)".format(out_dir))
+  audiopaths = [x[0] for x in _unique_paths(filelists)]
+
+  with ShardedArrayWriter(out_dir, np.float32, (hparams.n_mel_channels,), meta, max_shard_bytes, append,
+                          resume=not append) as writer:
+    todo = [(x, _source_stamp(x)) for x in audiopaths]
+    todo = [(x, stamp) for x, stamp in todo if writer.stamp_of(x) != stamp]
+    logging.info("Computing {} of {} mels".format(len(todo), len(audiopaths)))
+    extract = _mel_extractor(hparams)  # also imports the STFT code once, before forking
+    if num_workers > 1 and len(todo) > 0:
+      pool = multiprocessing.Pool(num_workers, _init_mel_worker, (hparams,))
+      extract_all = lambda paths: pool.imap(_extract_mel_in_worker, paths, chunksize=4)
+    else:
+      pool = None
+      extract_all = lambda paths: map(extract, paths)
+    try:
+      for start in range(0, len(todo), chunk_size):
+        chunk = todo[start:start + chunk_size]
+        for (audiopath, stamp), mel in zip(chunk, extract_all([x[0] for x in chunk])):
+          writer.add(audiopath, mel, stamp)
+        writer.commit()
+        logging.info("{}/{} mels".format(start + len(chunk), len(todo)))
+    finally:
+      if pool is not None:
+        pool.terminate()
+  return len(todo), len(audiopaths)
+
+
+class AudioArchive(ShardedArrayReader):
+  """16-bit PCM of whole filelists, keyed by the audio path used in the filelists."""
+  def __init__(self, root, sampling_rate=None):
+    super().__init__(root)
+    self.sampling_rate = self.meta["sampling_rate"]
+    if sampling_rate is not None and self.sampling_rate != sampling_rate:
+      raise ValueError("Audio archive {} holds {} SR audio, expected {} SR".format(
+        root, self.sampling_rate, sampling_rate))
+
+  def get_audio(self, audiopath):
+    """Same as utils.load_wav_to_torch, only the requested samples are read and converted."""
+    pcm = self.get(audiopath)
+    return torch.from_numpy(pcm.astype(np.float32)), self.sampling_rate
+
+
+def _read_pcm(audiopath):
+  sampling_rate, data = read(audiopath, mmap=True)
+  if data.dtype != np.int16 or data.ndim != 1:
+    raise ValueError("{} is not 16-bit mono PCM".format(audiopath))
+  return sampling_rate, data
+
+
+def build_audio_archive(filelists, out_dir, max_shard_bytes=MAX_SHARD_BYTES):
+  """Packs the audio of every file in `filelists`, which must share one sampling rate."""
+  audiopaths = [x[0] for x in _unique_paths(filelists)]
+
+  meta = {"kind": "audio", "sampling_rate": None}
+  with ShardedArrayWriter(out_dir, np.int16, (), meta, max_shard_bytes) as writer:
+    for audiopath in audiopaths:
+      sampling_rate, data = _read_pcm(audiopath)
+      if meta["sampling_rate"] is None:
+        meta["sampling_rate"] = sampling_rate
+      elif sampling_rate != meta["sampling_rate"]:
+        raise ValueError("{} {} SR doesn't match the {} SR of the archive".format(
+          audiopath, sampling_rate, meta["sampling_rate"]))
+      writer.add(audiopath, data)
+  return len(audiopaths)
+
+
+def text_params(hparams):
+  """Everything the token ids of a transcript depend on."""
+  from text.symbols import symbols
+  cmudict_path = getattr(hparams, "cmudict_path", None)
+  cmudict_hash = None
+  if cmudict_path is not None:
+    with open(cmudict_path, "rb") as f:
+      cmudict_hash = hashlib.sha1(f.read()).hexdigest()
+  return {
+    "text_cleaners": list(hparams.text_cleaners),
+    "cmudict": cmudict_hash,
+    "add_blank": bool(getattr(hparams, "add_blank", False)),
+    "symbols": hashlib.sha1("".join(symbols).encode("utf-8")).hexdigest(),
+  }
+
+
+class TokenStore(ShardedArrayReader):
+  """int16 token ids keyed by transcript, under <root>/<hash of the text frontend config>."""
+  def __init__(self, root, hparams):
+    params = text_params(hparams)
+    super().__init__(os.path.join(root, params_key(params)))
+
+  @classmethod
+  def open(cls, root, hparams):
+    """Returns None if no store was built for the text frontend config of `hparams`."""
+    try:
+      return cls(root, hparams)
+    except FileNotFoundError:
+      logging.warning("No token store for this text config in {}, running the text frontend instead".format(root))
+      return None
+
+  def get_tokens(self, text):
+    return torch.from_numpy(self.get(text).astype(np.int32))
+
+
+def _text_frontend(hparams):
+  """Returns text -> int16 token ids, computed like TextMelLoader.get_text does."""
+  import commons
+  from text import text_to_sequence, cmudict
+  from text.symbols import symbols
+
+  dictionary = None
+  if getattr(hparams, "cmudict_path", None) is not None:
+    dictionary = cmudict.CMUDict(hparams.cmudict_path)
+  add_blank = getattr(hparams, "add_blank", False)
+
+  def tokenize(text):
+    text_norm = text_to_sequence(text, hparams.text_cleaners, dictionary)
+    if add_blank:
+      text_norm = commons.intersperse(text_norm, len(symbols))
+    return np.array(text_norm, dtype=np.int16)
+  return tokenize
+
+
+def build_token_store(filelists, root, hparams, max_shard_bytes=MAX_SHARD_BYTES):
+  """Runs the text frontend once for every distinct transcript in `filelists`."""
+  tokenize = _text_frontend(hparams)
+  texts = []
+  seen = set()
+  for filelist in filelists:
+    for audiopath_and_text in load_filepaths_and_text(filelist):
+      text = audiopath_and_text[-1]
+      if text not in seen:
+        seen.add(text)
+        texts.append(text)
+
+  params = text_params(hparams)
+  out_dir = os.path.join(root, params_key(params))
+  meta = {"kind": "tokens", "params": params}
+  with ShardedArrayWriter(out_dir, np.int16, (), meta, max_shard_bytes) as writer:
+    for text in texts:
+      writer.add(text, tokenize(text))
+  return len(texts)
+
+
+def update_token_store(filelists, root, hparams, max_shard_bytes=MAX_SHARD_BYTES):
+  """Like build_token_store, but only runs the text frontend for transcripts missing from the
+  store of the current text config; a changed config gets a store of its own anyway.
+  Returns (number of transcripts tokenized, number of transcripts).
+  """
+  tokenize = _text_frontend(hparams)
+  texts = list(dict.fromkeys(x[-1] for filelist in filelists for x in load_filepaths_and_text(filelist)))
+
+  params = text_params(hparams)
+  out_dir = os.path.join(root, params_key(params))
+  meta = {"kind": "tokens", "params": params}
+  with ShardedArrayWriter(out_dir, np.int16, (), meta, max_shard_bytes, append=True) as writer:
+    todo = [text for text in texts if writer.stamp_of(text) is None]
+    for text in todo:
+      writer.add(text, tokenize(text))
+  return len(todo), len(texts)
+
+
+SAMPLE_SHARD_INDEX = "shards.json"
+SAMPLE_SHARD_FILE = "shard_{:05d}.tar"
+
+
+def _npy_bytes(array):
+  f = io.BytesIO()
+  np.save(f, array, allow_pickle=False)
+  return f.getvalue()
+
+
+def _add_member(tar, name, data):
+  info = tarfile.TarInfo(name)
+  info.size = len(data)
+  tar.addfile(info, io.BytesIO(data))
+
+
+def build_sample_shards(filelists, out_dir, hparams, features="audio", samples_per_shard=1000, seed=1234):
+  """Writes tar shards of whole training samples, to be read back strictly sequentially.
+
+  Every sample is stored as consecutive members
+    <key>.json        {"audiopath": ..., "text": ...}
+    <key>.tokens.npy  int16 token ids of the configured text frontend
+    <key>.audio.npy   int16 PCM (features="audio"), or
+    <key>.mel.npy     float32 [n_mel_channels, T] mel (features="mel")
+  and shards.json lists the shards with their sample counts. Samples are shuffled once
+  here, readers only shuffle within a bounded buffer.
+  """
+  assert features in ("audio", "mel"), "features must be 'audio' or 'mel'"
+  tokenize = _text_frontend(hparams)
+  extract = _mel_extractor(hparams) if features == "mel" else None
+  audiopaths_and_text = _unique_paths(filelists)
+  random.Random(seed).shuffle(audiopaths_and_text)
+
+  os.makedirs(out_dir, exist_ok=True)
+  shards = []
+  for start in range(0, len(audiopaths_and_text), samples_per_shard):
+    shard_file = SAMPLE_SHARD_FILE.format(len(shards))
+    samples = audiopaths_and_text[start:start + samples_per_shard]
+    with tarfile.open(os.path.join(out_dir, shard_file), "w") as tar:
+      for i, (audiopath, text) in enumerate(samples):
+        key = "{:09d}".format(start + i)
+        metadata = {"audiopath": audiopath, "text": text}
+        _add_member(tar, key + ".json", json.dumps(metadata).encode("utf-8"))
+        _add_member(tar, key + ".tokens.npy", _npy_bytes(tokenize(text)))
+        if features == "mel":
+          _add_member(tar, key + ".mel.npy", _npy_bytes(np.ascontiguousarray(extract(audiopath).T)))
+        else:
+          sampling_rate, data = _read_pcm(audiopath)
+          if sampling_rate != hparams.sampling_rate:
+            raise ValueError("{} {} SR doesn't match target {} SR".format(
+              audiopath, sampling_rate, hparams.sampling_rate))
+          _add_member(tar, key + ".audio.npy", _npy_bytes(np.asarray(data)))
+    shards.append({"file": shard_file, "count": len(samples)})
+
+  index = {
+    "features": features,
+    "params": mel_params(hparams),
+    "text_params": text_params(hparams),
+    "shards": shards,
+  }
+  # written last, like the index of a feature store
+  tmp_path = os.path.join(out_dir, SAMPLE_SHARD_INDEX + ".tmp")
+  with open(tmp_path, "w") as f:
+    json.dump(index, f, indent=2)
+  os.replace(tmp_path, os.path.join(out_dir, SAMPLE_SHARD_INDEX))
+  return len(audiopaths_and_text)
+
+
+def load_sample_shard_index(root):
+  path = os.path.join(root, SAMPLE_SHARD_INDEX)
+  if not os.path.isfile(path):
+    raise FileNotFoundError("{} has no complete sample shards (no {})".format(root, SAMPLE_SHARD_INDEX))
+  with open(path) as f:
+    return json.load(f)
+
+
+def iter_sample_shard(path):
+  """Yields the samples of one shard as {suffix: decoded member}, reading the file once front to back."""
+  key, sample = None, {}
+  with tarfile.open(path, "r|") as tar:
+    for member in tar:
+      member_key, suffix = member.name.split(".", 1)
+      if key is not None and member_key != key:
+        yield sample
+        sample = {}
+      key = member_key
+      data = tar.extractfile(member).read()
+      if suffix.endswith(".npy"):
+        sample[suffix[:-4]] = np.load(io.BytesIO(data), allow_pickle=False)
+      else:
+        sample[suffix] = json.loads(data)
+  if key is not None:
+    yield sample
@@ -58,11 +58,17 @@ def make_json(train_files: str, val_files: str, epochs: int, load_mels: bool) ->
             "warmup_steps": 4000,
             "scheduler": "noam",
             "batch_size": 64,
+            "num_workers": 8,
+            "prefetch_factor": 2,
+            "persistent_workers": True,
             "ddi": True,
+            "duration_cache_epochs": 0,
+            "duration_cache_loss_drift": 0,
             "fp16_run": True,
         },
         "data": {
             "load_mel_from_disk": load_mels,
+            "mel_on_device": False,
             "training_files": train_files,
             "validation_files": val_files,
             "text_cleaners": ["english_cleaners"],
@@ -96,6 +102,8 @@ def make_json(train_files: str, val_files: str, epochs: int, load_mels: bool) ->
             "hidden_channels_enc": 192,
             "hidden_channels_dec": 192,
             "window_size": 4,
+            "mas_band_width": 0,
+            "logp_chunk_size": 128,
         },
     }
 
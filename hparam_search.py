@@ -20,7 +20,7 @@ from apex.parallel import DistributedDataParallel as DDP
 from apex import amp
 
 from utils import HParams
-from data_utils import TextMelLoader, TextMelCollate
+from data_utils import TextMelLoader, TextMelCollate, DistributedBucketSampler, loader_worker_kwargs
 import models
 import commons
 import utils
@@ -35,6 +35,9 @@ MODEL_DIR = "models/optuna_trials"
 KEEP_EVERY = 20
 CHKPT_PATT = r"G_\d+\.pth"
 DATADIR = "/home/kjayathunge/datasets/LJS"
+BATCH_SIZE = 256 # reference batch size of the learning rate schedule
+MAX_FRAMES = 256 * 400 # per-GPU frame budget, 256 utterances of ~400 mel frames
+BOUNDARIES = [32, 300, 400, 500, 600, 700, 800, 900, 1000]
 
 
 def start_search(gamma, aug_method, opt_config, resume):
@@ -161,7 +164,11 @@ def hps_set_params(trial, project, gamma, params, filelist_dir, aug_method, opt_
         params_dict = json.load(fh)
         all_params = HParams(**params_dict)
 
-    all_params.train.batch_size = 256
+    # size batches by frames, a fixed 256 utterances runs out of memory on long batches
+    all_params.train.batch_size = BATCH_SIZE
+    all_params.train.max_frames = MAX_FRAMES
+    if getattr(all_params.train, "boundaries", None) is None:
+      all_params.train.boundaries = BOUNDARIES
     all_params.model_dir = model_dir
     # hps.train.epochs =  100 #delete this line
 
@@ -183,21 +190,44 @@ def train_and_eval(rank, n_gpus, hps, trial):
   torch.cuda.set_device(rank)
 
   train_dataset = TextMelLoader(hps.data.training_files, hps.data)
-  train_sampler = torch.utils.data.distributed.DistributedSampler(
-      train_dataset,
-      num_replicas=n_gpus,
-      rank=rank,
-      shuffle=True)
-  collate_fn = TextMelCollate(1)
-  train_loader = DataLoader(train_dataset, num_workers=8, shuffle=False,
-      batch_size=hps.train.batch_size, pin_memory=True,
-      drop_last=True, collate_fn=collate_fn, sampler=train_sampler)
+  collate_fn = TextMelCollate(hparams=hps.data, n_frames_per_step=1)
+  worker_kwargs = loader_worker_kwargs(hps.train, 8)
+  max_frames = getattr(hps.train, "max_frames", None)
+  if getattr(hps.train, "boundaries", None) is not None or max_frames is not None:
+    # batches of similar mel lengths, optionally sized by a frame budget
+    train_sampler = DistributedBucketSampler(
+        train_dataset,
+        hps.train.batch_size,
+        getattr(hps.train, "boundaries", None) or [0, float("inf")],
+        num_replicas=n_gpus,
+        rank=rank,
+        shuffle=True,
+        max_frames=max_frames,
+        frame_budget=getattr(hps.train, "frame_budget", "max"))
+    train_loader = DataLoader(train_dataset, shuffle=False, **worker_kwargs,
+        pin_memory=True, collate_fn=collate_fn, batch_sampler=train_sampler)
+  else:
+    train_sampler = torch.utils.data.distributed.DistributedSampler(
+        train_dataset,
+        num_replicas=n_gpus,
+        rank=rank,
+        shuffle=True)
+    train_loader = DataLoader(train_dataset, shuffle=False, **worker_kwargs,
+        batch_size=hps.train.batch_size, pin_memory=True,
+        drop_last=True, collate_fn=collate_fn, sampler=train_sampler)
   if rank == 0:
     val_dataset = TextMelLoader(hps.data.validation_files, hps.data)
-    val_loader = DataLoader(val_dataset, num_workers=8, shuffle=False,
+    val_loader = DataLoader(val_dataset, shuffle=False, **worker_kwargs,
         batch_size=hps.train.val_batch_size, pin_memory=True,
         drop_last=True, collate_fn=collate_fn)
 
+  mel_stft = None
+  if getattr(hps.data, "mel_on_device", False):
+    mel_stft = commons.TacotronSTFT(
+        hps.data.filter_length, hps.data.hop_length, hps.data.win_length,
+        hps.data.n_mel_channels, hps.data.sampling_rate, hps.data.mel_fmin,
+        hps.data.mel_fmax).cuda(rank)
+
   generator = models.FlowGenerator(
       n_vocab=len(symbols) + getattr(hps.data, "add_blank", False), 
       out_channels=hps.data.n_mel_channels, 
@@ -211,7 +241,10 @@ def train_and_eval(rank, n_gpus, hps, trial):
   try:
     _, _, _, epoch_str = utils.load_checkpoint(utils.latest_checkpoint_path(hps.model_dir, "G_*.pth"), generator, optimizer_g)
     epoch_str += 1
-    optimizer_g.step_num = (epoch_str - 1) * len(train_loader)
+    if isinstance(train_sampler, DistributedBucketSampler):
+      optimizer_g.step_num = (epoch_str - 1) * train_sampler.reference_steps_per_epoch()
+    else:
+      optimizer_g.step_num = (epoch_str - 1) * len(train_loader)
     optimizer_g._update_learning_rate()
     global_step = (epoch_str - 1) * len(train_loader)
   except:
@@ -222,8 +255,8 @@ def train_and_eval(rank, n_gpus, hps, trial):
   eval_loss = 0
   for epoch in range(epoch_str, hps.train.epochs + 1):
     if rank==0:
-      train_loss = train(rank, epoch, hps, generator, optimizer_g, train_loader, logger, writer)
-      eval_loss = evaluate(rank, epoch, hps, generator, optimizer_g, val_loader, logger, writer_eval)
+      train_loss = train(rank, epoch, hps, generator, optimizer_g, train_loader, logger, writer, mel_stft)
+      eval_loss = evaluate(rank, epoch, hps, generator, optimizer_g, val_loader, logger, writer_eval, mel_stft)
       utils.save_checkpoint(generator, optimizer_g, hps.train.learning_rate, epoch, os.path.join(hps.model_dir, "G_{}.pth".format(epoch)))
       print(f"val_loss: {eval_loss}, train_loss: {train_loss}")
       wandb.log({"val_loss": eval_loss, "train_loss": train_loss}, step=epoch)
@@ -231,13 +264,16 @@ def train_and_eval(rank, n_gpus, hps, trial):
       if trial.should_prune():
             raise optuna.TrialPruned()
     else:
-      train(rank, epoch, hps, generator, optimizer_g, train_loader, None, None)
+      train(rank, epoch, hps, generator, optimizer_g, train_loader, None, None, mel_stft)
 
   return train_loss, eval_loss
 
 
-def train(rank, epoch, hps, generator, optimizer_g, train_loader, logger, writer):
-  train_loader.sampler.set_epoch(epoch)
+def train(rank, epoch, hps, generator, optimizer_g, train_loader, logger, writer, mel_stft=None):
+  if isinstance(train_loader.batch_sampler, DistributedBucketSampler):
+    train_loader.batch_sampler.set_epoch(epoch)
+  else:
+    train_loader.sampler.set_epoch(epoch)
   global global_step
 
   final_loss = 0
@@ -245,6 +281,9 @@ def train(rank, epoch, hps, generator, optimizer_g, train_loader, logger, writer
   for batch_idx, (x, x_lengths, y, y_lengths) in enumerate(train_loader):
     x, x_lengths = x.cuda(rank, non_blocking=True), x_lengths.cuda(rank, non_blocking=True)
     y, y_lengths = y.cuda(rank, non_blocking=True), y_lengths.cuda(rank, non_blocking=True)
+    if mel_stft is not None:
+      # the loader ships padded signals, the whole batch is transformed here
+      y, y_lengths = mel_stft.mel_spectrogram(y, y_lengths), mel_stft.num_frames(y_lengths)
 
     # Train Generator
     optimizer_g.zero_grad()
@@ -263,7 +302,11 @@ def train(rank, epoch, hps, generator, optimizer_g, train_loader, logger, writer
     else:
       loss_g.backward()
       grad_norm = commons.clip_grad_value_(generator.parameters(), 5)
-    optimizer_g.step()
+    if isinstance(train_loader.batch_sampler, DistributedBucketSampler):
+      # variable-size batches advance the noam schedule by their size
+      optimizer_g.step(train_loader.batch_sampler.step_scale(batch_idx))
+    else:
+      optimizer_g.step()
     
     if rank==0:
       if batch_idx % hps.train.log_interval == 0:
@@ -293,7 +336,7 @@ def train(rank, epoch, hps, generator, optimizer_g, train_loader, logger, writer
   return final_loss
  
 
-def evaluate(rank, epoch, hps, generator, optimizer_g, val_loader, logger, writer_eval):
+def evaluate(rank, epoch, hps, generator, optimizer_g, val_loader, logger, writer_eval, mel_stft=None):
   if rank == 0:
     global global_step
     generator.eval()
@@ -304,6 +347,8 @@ def evaluate(rank, epoch, hps, generator, optimizer_g, val_loader, logger, write
       for batch_idx, (x, x_lengths, y, y_lengths) in enumerate(val_loader):
         x, x_lengths = x.cuda(rank, non_blocking=True), x_lengths.cuda(rank, non_blocking=True)
         y, y_lengths = y.cuda(rank, non_blocking=True), y_lengths.cuda(rank, non_blocking=True)
+        if mel_stft is not None:
+          y, y_lengths = mel_stft.mel_spectrogram(y, y_lengths), mel_stft.num_frames(y_lengths)
 
         
         (z, z_m, z_logs, logdet, z_mask), (x_m, x_logs, x_mask), (attn, logw, logw_) = generator(x, x_lengths, y, y_lengths, gen=False)
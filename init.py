@@ -7,7 +7,7 @@ from torch import nn, optim
 from torch.nn import functional as F
 from torch.utils.data import DataLoader
 
-from data_utils import TextMelLoader, TextMelCollate
+from data_utils import TextMelLoader, TextMelCollate, loader_worker_kwargs
 import models
 import commons
 import utils
@@ -33,10 +33,17 @@ def main(hps):
 
   train_dataset = TextMelLoader(hps.data.training_files, hps.data)
   collate_fn = TextMelCollate(hparams=hps.data, n_frames_per_step=1)
-  train_loader = DataLoader(train_dataset, num_workers=8, shuffle=True,
+  train_loader = DataLoader(train_dataset, shuffle=True, **loader_worker_kwargs(hps.train, 8),
       batch_size=hps.train.batch_size, pin_memory=True,
       drop_last=True, collate_fn=collate_fn)
 
+  mel_stft = None
+  if getattr(hps.data, "mel_on_device", False):
+    mel_stft = commons.TacotronSTFT(
+        hps.data.filter_length, hps.data.hop_length, hps.data.win_length,
+        hps.data.n_mel_channels, hps.data.sampling_rate, hps.data.mel_fmin,
+        hps.data.mel_fmax).cuda()
+
   generator = FlowGenerator_DDI(
       len(symbols) + getattr(hps.data, "add_blank", False), 
       out_channels=hps.data.n_mel_channels,
@@ -47,6 +54,9 @@ def main(hps):
   for batch_idx, (x, x_lengths, y, y_lengths) in enumerate(train_loader):
     x, x_lengths = x.cuda(), x_lengths.cuda()
     y, y_lengths = y.cuda(), y_lengths.cuda()
+    if mel_stft is not None:
+      # the loader ships padded signals, the whole batch is transformed here
+      y, y_lengths = mel_stft.mel_spectrogram(y, y_lengths), mel_stft.num_frames(y_lengths)
 
     _ = generator(x, x_lengths, y, y_lengths, gen=False)
     break
@@ -112,7 +112,7 @@ class TextEncoder(nn.Module):
     if not self.mean_only:
       x_logs = self.proj_s(x) * x_mask
     else:
-      x_logs = torch.zeros_like(x_m)
+      x_logs = None # unit scale, see FlowGenerator.forward and commons.mle_loss
 
     logw = self.proj_w(x_dp, x_mask)
     return x_m, x_logs, logw, x_mask
@@ -212,6 +212,8 @@ class FlowGenerator(nn.Module):
       hidden_channels_enc=None,
       hidden_channels_dec=None,
       prenet=False,
+      mas_band_width=0,
+      logp_chunk_size=128,
       **kwargs):
 
     super().__init__()
@@ -240,6 +242,8 @@ class FlowGenerator(nn.Module):
     self.hidden_channels_enc = hidden_channels_enc
     self.hidden_channels_dec = hidden_channels_dec
     self.prenet = prenet
+    self.mas_band_width = mas_band_width
+    self.logp_chunk_size = logp_chunk_size
 
     self.encoder = TextEncoder(
         n_vocab, 
@@ -274,7 +278,13 @@ class FlowGenerator(nn.Module):
       self.emb_g = nn.Embedding(n_speakers, gin_channels)
       nn.init.uniform_(self.emb_g.weight, -0.1, 0.1)
 
-  def forward(self, x, x_lengths, y=None, y_lengths=None, g=None, gen=False, noise_scale=1., length_scale=1.):
+  def forward(self, x, x_lengths, y=None, y_lengths=None, g=None, gen=False, noise_scale=1., length_scale=1., prev_durations=None, durations=None,
+      return_attn=False):
+    """ durations: optional [b, t_x] token durations (in frames of y_lengths // n_sqz * n_sqz) of
+        a hard alignment found before, used instead of searching one (see utils.DurationCache)
+        return_attn: also build the dense [b, 1, t, t'] alignment where it isn't anyway (generation
+        and given durations); the prior is expanded to frames by indexing either way
+    """
     if g is not None:
       g = F.normalize(self.emb_g(g)).unsqueeze(-1) # [b, h]
     x_m, x_logs, logw, x_mask = self.encoder(x, x_lengths, g=g)
@@ -290,31 +300,52 @@ class FlowGenerator(nn.Module):
     z_mask = torch.unsqueeze(commons.sequence_mask(y_lengths, y_max_length), 1).to(x_mask.dtype)
     attn_mask = torch.unsqueeze(x_mask, -1) * torch.unsqueeze(z_mask, 2)
 
+    attn = None
     if gen:
-      attn = commons.generate_path(w_ceil.squeeze(1), attn_mask.squeeze(1)).unsqueeze(1)
-      z_m = torch.matmul(attn.squeeze(1).transpose(1, 2), x_m.transpose(1, 2)).transpose(1, 2) # [b, t', t], [b, t, d] -> [b, d, t']
-      z_logs = torch.matmul(attn.squeeze(1).transpose(1, 2), x_logs.transpose(1, 2)).transpose(1, 2) # [b, t', t], [b, t, d] -> [b, d, t']
-      logw_ = torch.log(1e-8 + torch.sum(attn, -1)) * x_mask
+      # durations that fit in y_lengths, which preprocess rounded down to a multiple of n_sqz
+      cum_duration = torch.minimum(torch.cumsum(w_ceil.squeeze(1), 1), y_lengths.unsqueeze(1).to(w_ceil.dtype))
+      durations = cum_duration - F.pad(cum_duration, [1, 0])[:, :-1]
+    else:
+      z, logdet = self.decoder(y, z_mask, g=g, reverse=False)
+      if durations is None:
+        attn = self.search_alignment(z, x_m, x_logs, x_lengths, y_lengths, y_max_length, attn_mask, prev_durations)
+        durations = torch.sum(attn, -1).squeeze(1)
+      durations = durations.to(x_mask.dtype)
+    if attn is None and return_attn:
+      attn = commons.generate_path(durations, attn_mask.squeeze(1)).unsqueeze(1)
+    index = commons.duration_index(durations, z_mask.size(2)) # [b, t'], token of each frame
+    z_m = commons.expand_by_index(x_m, index) * z_mask # [b, d, t] -> [b, d, t']
+    z_logs = None if x_logs is None else commons.expand_by_index(x_logs, index) * z_mask # [b, d, t] -> [b, d, t']
+    logw_ = torch.log(1e-8 + durations.unsqueeze(1)) * x_mask
 
-      z = (z_m + torch.exp(z_logs) * torch.randn_like(z_m) * noise_scale) * z_mask
+    if gen:
+      # noise in the [b, t', d] memory layout the former matmul expansion had, so that a seed
+      # still gives the same samples
+      noise = z_m.new_empty(z_m.size(0), z_m.size(2), z_m.size(1)).transpose(1, 2).normal_()
+      z = (z_m + (noise if z_logs is None else torch.exp(z_logs) * noise) * noise_scale) * z_mask
       y, logdet = self.decoder(z, z_mask, g=g, reverse=True)
       return (y, z_m, z_logs, logdet, z_mask), (x_m, x_logs, x_mask), (attn, logw, logw_)
     else:
-      z, logdet = self.decoder(y, z_mask, g=g, reverse=False)
-      with torch.no_grad():
-        x_s_sq_r = torch.exp(-2 * x_logs)
-        logp1 = torch.sum(-0.5 * math.log(2 * math.pi) - x_logs, [1]).unsqueeze(-1) # [b, t, 1]
-        logp2 = torch.matmul(x_s_sq_r.transpose(1,2), -0.5 * (z ** 2)) # [b, t, d] x [b, d, t'] = [b, t, t']
-        logp3 = torch.matmul((x_m * x_s_sq_r).transpose(1,2), z) # [b, t, d] x [b, d, t'] = [b, t, t']
-        logp4 = torch.sum(-0.5 * (x_m ** 2) * x_s_sq_r, [1]).unsqueeze(-1) # [b, t, 1]
-        logp = logp1 + logp2 + logp3 + logp4 # [b, t, t']
-
-        attn = monotonic_align.maximum_path(logp, attn_mask.squeeze(1)).unsqueeze(1).detach()
-      z_m = torch.matmul(attn.squeeze(1).transpose(1, 2), x_m.transpose(1, 2)).transpose(1, 2) # [b, t', t], [b, t, d] -> [b, d, t']
-      z_logs = torch.matmul(attn.squeeze(1).transpose(1, 2), x_logs.transpose(1, 2)).transpose(1, 2) # [b, t', t], [b, t, d] -> [b, d, t']
-      logw_ = torch.log(1e-8 + torch.sum(attn, -1)) * x_mask
       return (z, z_m, z_logs, logdet, z_mask), (x_m, x_logs, x_mask), (attn, logw, logw_)
 
+  @torch.no_grad()
+  def search_alignment(self, z, x_m, x_logs, x_lengths, y_lengths, y_max_length, attn_mask, prev_durations=None):
+    """ Most likely monotonic alignment [b, 1, t, t'] of the latents z to the prior """
+    logp = commons.log_likelihood_matrix(z, x_m, x_logs, self.logp_chunk_size) # [b, t, t']
+
+    return monotonic_align.maximum_path(logp, attn_mask.squeeze(1),
+        band=self.alignment_band(x_lengths, y_lengths, y_max_length, prev_durations)).unsqueeze(1).detach()
+
+  def alignment_band(self, x_lengths, y_lengths, y_max_length, prev_durations=None):
+    """ Band the alignment search is restricted to with mas_band_width > 0: around the previous
+        alignment if its token durations [b, t_x] are given, else around the diagonal
+    """
+    if self.mas_band_width <= 0:
+      return None
+    if prev_durations is not None:
+      return monotonic_align.alignment_band(prev_durations, y_max_length, self.mas_band_width)
+    return monotonic_align.diagonal_band(x_lengths, y_lengths, y_max_length, self.mas_band_width)
+
   def preprocess(self, y, y_lengths, y_max_length):
     if y_max_length is not None:
       y_max_length = (y_max_length // self.n_sqz) * self.n_sqz
@@ -1,21 +1,169 @@
+import os
 import numpy as np
 import torch
-from .monotonic_align.core import maximum_path_c
+try:
+  from .monotonic_align.core import maximum_path_c, maximum_path_banded_c
+except ImportError:  # extension not built, only the torch version is available
+  maximum_path_c = maximum_path_banded_c = None
 
 
-def maximum_path(value, mask):  
+# "cython", "torch" or "auto": the Cython extension if it is built, torch otherwise. The torch
+# version saves the host round trip on accelerators, but launches a few kernels per frame and
+# hasn't been shown to be faster on GPUs yet, so it is opt-in
+IMPLEMENTATION = os.environ.get("MONOTONIC_ALIGN", "auto")
+
+
+def maximum_path(value, mask, band=None):
+  """
+  value: [b, t_x, t_y]
+  mask: [b, t_x, t_y]
+  band: optional (lo, hi) [b, t_y] token ranges to search per frame (see diagonal_band and
+    alignment_band); items without a path inside their band get the full search
+  """
+  implementation = IMPLEMENTATION
+  if implementation == "auto":
+    implementation = "cython" if maximum_path_c is not None else "torch"
+  if implementation == "torch":
+    search = maximum_path_torch
+  elif implementation == "cython":
+    search = maximum_path_cython
+  else:
+    raise ValueError("Unknown MONOTONIC_ALIGN implementation {}".format(implementation))
+  if band is None:
+    return search(value, mask)
+
+  path, feasible = search(value, mask, band=band)
+  infeasible = torch.nonzero(~feasible).squeeze(1)
+  if infeasible.numel() > 0:
+    infeasible = infeasible.to(value.device)
+    path[infeasible] = search(value[infeasible], mask[infeasible])
+  return path
+
+
+def diagonal_band(x_lengths, y_lengths, t_y, width):
+  """ (lo, hi) [b, t_y]: tokens within `width` of the diagonal x = y * t_x / t_y of each item """
+  y = torch.arange(t_y, device=x_lengths.device, dtype=torch.float32).unsqueeze(0)
+  center = y * (x_lengths.float() / y_lengths.float()).unsqueeze(1)
+  return torch.floor(center - width).int(), torch.ceil(center + width).int() + 1
+
+
+def alignment_band(durations, t_y, width):
+  """ (lo, hi) [b, t_y]: tokens within `width` of a previous alignment, given by the frame
+  durations [b, t_x] of its tokens (e.g. attn.sum(-1) of the last epoch)
+  """
+  ends = torch.cumsum(durations.float(), 1).contiguous()
+  frames = torch.arange(t_y, device=ends.device, dtype=ends.dtype).unsqueeze(0).expand(ends.size(0), t_y)
+  token = torch.searchsorted(ends, frames.contiguous(), right=True)  # the token frame y belongs to
+  return (token - width).int(), (token + width + 1).int()
+
+
+# OpenMP threads of the Cython version, 0 (unset) for the OpenMP default (all cores or
+# OMP_NUM_THREADS), which the extension gets by leaving out the num_threads clause
+NUM_THREADS = int(os.environ.get("MONOTONIC_ALIGN_THREADS", "0"))
+
+_host_buffers = {}
+
+
+def _host_buffer(name, shape, dtype, pin=False):
+  """ Reused host tensor of `shape`, grown as needed """
+  numel = int(np.prod(shape))
+  buffer = _host_buffers.get(name)
+  if buffer is None or buffer.numel() < numel:
+    buffer = torch.empty(numel + numel // 4, dtype=dtype, pin_memory=pin)
+    _host_buffers[name] = buffer
+  return buffer[:numel].view(shape)
+
+
+def maximum_path_cython(value, mask, band=None, num_threads=None):
   """ Cython optimised version.
   value: [b, t_x, t_y]
   mask: [b, t_x, t_y]
+  band: optional (lo, hi) [b, t_y]; only cells lo <= x < hi are searched, returns
+    (path, feasible [b]) with empty paths where no path fits in the band
   """
-  value = value * mask
+  if maximum_path_c is None:
+    raise ImportError("monotonic_align extension is not built, see the README")
   device = value.device
   dtype = value.dtype
-  value = value.data.cpu().numpy().astype(np.float32)
-  path = np.zeros_like(value).astype(np.int32)
-  mask = mask.data.cpu().numpy()
-
-  t_x_max = mask.sum(1)[:, 0].astype(np.int32)
-  t_y_max = mask.sum(2)[:, 0].astype(np.int32)
-  maximum_path_c(path, value, t_x_max, t_y_max)
-  return torch.from_numpy(path).to(device=device, dtype=dtype)
+  value = value * mask
+  if device.type == "cpu":
+    # already a fresh tensor, the search may overwrite it in place
+    value = value.float().contiguous()
+  else:
+    value = _host_buffer("value", value.shape, torch.float32, pin=device.type == "cuda").copy_(value)
+  path = _host_buffer("path", value.shape, torch.int32)
+
+  t_x_max = mask[:, :, 0].sum(1).to(device="cpu", dtype=torch.int32)
+  t_y_max = mask[:, 0, :].sum(1).to(device="cpu", dtype=torch.int32)
+  num_threads = NUM_THREADS if num_threads is None else num_threads
+  if band is None:
+    maximum_path_c(path.numpy(), value.numpy(), t_x_max.numpy(), t_y_max.numpy(), -1e9, num_threads)
+    # always a copy, the buffer is reused by the next call
+    return path.to(device=device, dtype=dtype, copy=True)
+
+  lo, hi = [x.to(device="cpu", dtype=torch.int32).contiguous() for x in band]
+  feasible = torch.empty(value.size(0), dtype=torch.int32)
+  maximum_path_banded_c(path.numpy(), value.numpy(), t_x_max.numpy(), t_y_max.numpy(),
+      lo.numpy(), hi.numpy(), feasible.numpy(), -1e9, num_threads)
+  return path.to(device=device, dtype=dtype, copy=True), feasible.bool()
+
+
+@torch.no_grad()
+def maximum_path_torch(value, mask, band=None, max_neg_val=-1e9):
+  """ Same paths as maximum_path_c (maximum_path_banded_c with a band), computed on the device
+  of `value` without syncing. The DP runs column by column, batched over b and t_x.
+  value: [b, t_x, t_y]
+  mask: [b, t_x, t_y]
+  band: optional (lo, hi) [b, t_y], see maximum_path_cython
+  """
+  dtype = value.dtype
+  device = value.device
+  b, t_x, t_y = value.shape
+  columns = (value * mask).float().permute(2, 0, 1).contiguous()  # [t_y, b, t_x]
+  mask = mask.float()
+  t_xs = mask.sum(1)[:, 0].long()
+  t_ys = mask.sum(2)[:, 0].long()
+
+  x_range = torch.arange(t_x, device=device).view(1, 1, t_x)
+  y_range = torch.arange(t_y, device=device).view(t_y, 1, 1)
+  # cells maximum_path_c accumulates, the rest keep their raw values (or are unreachable if banded)
+  searched = (x_range >= (t_xs - t_ys).view(1, b, 1) + y_range) & (x_range < torch.minimum(t_xs.view(1, b, 1), y_range + 1))
+  if band is not None:
+    lo, hi = [x.to(device).t().unsqueeze(2) for x in band]  # [t_y, b, 1]
+    searched &= (x_range >= lo) & (x_range < hi)
+  diagonal = (x_range == y_range).expand(t_y, b, t_x)
+  neg = torch.tensor(max_neg_val, dtype=columns.dtype, device=device)
+
+  # direction[y, :, x]: the path through (x, y) comes from (x - 1, y - 1), decided on column
+  # y - 1 exactly like the backtracking of maximum_path_c does
+  direction = torch.zeros(t_y, b, t_x, dtype=torch.bool, device=device)
+  # buffer[:, 1:] is column y - 1 (accumulated where searched), buffer[:, :-1] its shift
+  buffer = torch.full((b, t_x + 1), max_neg_val, dtype=columns.dtype, device=device)
+  buffer[:, 0] = 0.  # (0, 0) starts from 0, every other x == 0 cell from max_neg_val
+  if band is not None:
+    last = torch.arange(t_y, device=device).view(t_y, 1) == (t_ys - 1).view(1, b)
+    last_index = torch.arange(b, device=device) * (t_x + 1) + t_xs  # (t_x - 1, t_y - 1) in buffer
+    final = torch.full((b,), max_neg_val, dtype=columns.dtype, device=device)
+  for y in range(t_y):
+    prev, shifted = buffer[:, 1:], buffer[:, :-1]
+    if y > 0:
+      torch.logical_or(diagonal[y], prev < shifted, out=direction[y])
+    acc = torch.maximum(torch.where(diagonal[y], neg, prev), shifted).add_(columns[y])
+    buffer[:, 1:] = torch.where(searched[y], acc, columns[y] if band is None else neg)
+    buffer[:, 0] = max_neg_val
+    if band is not None:
+      final = torch.where(last[y], buffer.view(-1).index_select(0, last_index), final)
+  direction[:, :, 0] = False
+
+  path = torch.zeros(t_y, b * t_x, dtype=dtype, device=device)
+  direction = direction.view(t_y, b * t_x)
+  active = y_range.view(t_y, 1) < t_ys.view(1, b)  # [t_y, b]
+  index = torch.arange(b, device=device) * t_x + t_xs - 1  # flat (batch, x)
+  for y in reversed(range(t_y)):
+    path[y].index_copy_(0, index, active[y].to(dtype))
+    index = index - (active[y] & direction[y].index_select(0, index)).long()
+  path = path.view(t_y, b, t_x).permute(1, 2, 0).contiguous()
+  if band is None:
+    return path
+  feasible = final > max_neg_val / 2
+  return path * feasible.view(b, 1, 1).to(dtype), feasible
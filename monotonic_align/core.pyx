@@ -2,11 +2,13 @@ import numpy as np
 cimport numpy as np
 cimport cython
 from cython.parallel import prange
+from libc.string cimport memset
 
 
 @cython.boundscheck(False)
 @cython.wraparound(False)
-cdef void maximum_path_each(int[:,::1] path, float[:,::1] value, int t_x, int t_y, float max_neg_val) nogil:
+# int rather than void: Cython 3 would otherwise take the GIL after every call to check for exceptions
+cdef int maximum_path_each(int[:,::1] path, float[:,::1] value, int t_x, int t_y, float max_neg_val) nogil:
   cdef int x
   cdef int y
   cdef float v_prev
@@ -14,6 +16,8 @@ cdef void maximum_path_each(int[:,::1] path, float[:,::1] value, int t_x, int t_
   cdef float tmp
   cdef int index = t_x - 1
 
+  # the whole path is written, so callers can pass reused buffers
+  memset(&path[0, 0], 0, path.shape[0] * path.shape[1] * sizeof(int))
   for y in range(t_y):
     for x in range(max(0, t_x + y - t_y), min(t_x, y + 1)):
       if x == y:
@@ -33,13 +37,95 @@ cdef void maximum_path_each(int[:,::1] path, float[:,::1] value, int t_x, int t_
     path[index, y] = 1
     if index != 0 and (index == y or value[index, y-1] < value[index-1, y-1]):
       index = index - 1
+  return 1
 
 
 @cython.boundscheck(False)
 @cython.wraparound(False)
-cpdef void maximum_path_c(int[:,:,::1] paths, float[:,:,::1] values, int[::1] t_xs, int[::1] t_ys, float max_neg_val=-1e9) nogil:
+cpdef void maximum_path_c(int[:,:,::1] paths, float[:,:,::1] values, int[::1] t_xs, int[::1] t_ys, float max_neg_val=-1e9, int num_threads=1) nogil:
   cdef int b = values.shape[0]
+  cdef int n_threads = num_threads
 
   cdef int i
-  for i in prange(b, nogil=True):
-    maximum_path_each(paths[i], values[i], t_xs[i], t_ys[i], max_neg_val)
+  # lengths vary within a batch, so items are handed out dynamically. OpenMP requires a
+  # positive num_threads, without the clause it uses its default (OMP_NUM_THREADS or all cores)
+  if n_threads > 0:
+    for i in prange(b, nogil=True, num_threads=n_threads, schedule='dynamic'):
+      maximum_path_each(paths[i], values[i], t_xs[i], t_ys[i], max_neg_val)
+  else:
+    for i in prange(b, nogil=True, schedule='dynamic'):
+      maximum_path_each(paths[i], values[i], t_xs[i], t_ys[i], max_neg_val)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef inline float banded_value(float[:,::1] value, int x, int y, int lo, int hi, float max_neg_val) nogil:
+  if x < lo or x >= hi:
+    return max_neg_val
+  return value[x, y]
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef int maximum_path_banded_each(int[:,::1] path, float[:,::1] value, int[::1] lo, int[::1] hi, int t_x, int t_y, float max_neg_val) nogil:
+  """Like maximum_path_each, but only cells with lo[y] <= x < hi[y] are searched, the others
+  are unreachable. Returns 0 (and an empty path) if no path fits in the band.
+  """
+  cdef int x
+  cdef int y
+  cdef int x_lo
+  cdef int x_hi
+  cdef int prev_lo = 0
+  cdef int prev_hi = 0
+  cdef float v_prev
+  cdef float v_cur
+  cdef int index = t_x - 1
+
+  memset(&path[0, 0], 0, path.shape[0] * path.shape[1] * sizeof(int))
+  for y in range(t_y):
+    x_lo = max(max(0, t_x + y - t_y), lo[y])
+    x_hi = min(min(t_x, y + 1), hi[y])
+    for x in range(x_lo, x_hi):
+      if x == y:
+        v_cur = max_neg_val
+      else:
+        v_cur = banded_value(value, x, y-1, prev_lo, prev_hi, max_neg_val)
+      if x == 0:
+        if y == 0:
+          v_prev = 0.
+        else:
+          v_prev = max_neg_val
+      else:
+        v_prev = banded_value(value, x-1, y-1, prev_lo, prev_hi, max_neg_val)
+      value[x, y] = max(v_cur, v_prev) + value[x, y]
+    prev_lo = x_lo
+    prev_hi = x_hi
+
+  if index < prev_lo or index >= prev_hi or value[index, t_y-1] <= max_neg_val / 2:
+    return 0
+  for y in range(t_y - 1, -1, -1):
+    path[index, y] = 1
+    if index != 0:
+      if index == y:
+        index = index - 1
+      else:
+        x_lo = max(max(0, t_x + y - 1 - t_y), lo[y-1])
+        x_hi = min(min(t_x, y), hi[y-1])
+        if banded_value(value, index, y-1, x_lo, x_hi, max_neg_val) < banded_value(value, index-1, y-1, x_lo, x_hi, max_neg_val):
+          index = index - 1
+  return 1
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cpdef void maximum_path_banded_c(int[:,:,::1] paths, float[:,:,::1] values, int[::1] t_xs, int[::1] t_ys, int[:,::1] los, int[:,::1] his, int[::1] feasible, float max_neg_val=-1e9, int num_threads=1) nogil:
+  cdef int b = values.shape[0]
+  cdef int n_threads = num_threads
+
+  cdef int i
+  if n_threads > 0:
+    for i in prange(b, nogil=True, num_threads=n_threads, schedule='dynamic'):
+      feasible[i] = maximum_path_banded_each(paths[i], values[i], los[i], his[i], t_xs[i], t_ys[i], max_neg_val)
+  else:
+    for i in prange(b, nogil=True, schedule='dynamic'):
+      feasible[i] = maximum_path_banded_each(paths[i], values[i], los[i], his[i], t_xs[i], t_ys[i], max_neg_val)
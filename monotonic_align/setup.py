@@ -1,9 +1,24 @@
+import os
+import sys
 from distutils.core import setup
+from distutils.extension import Extension
 from Cython.Build import cythonize
 import numpy
 
+# prange in core.pyx only runs in parallel when compiled and linked with OpenMP;
+# build with MONOTONIC_ALIGN_OPENMP=0 on toolchains without it (e.g. Apple clang without libomp)
+if os.environ.get("MONOTONIC_ALIGN_OPENMP", "1") == "0":
+  openmp_flags = []
+elif sys.platform == "win32":
+  openmp_flags = ["/openmp"]
+else:
+  openmp_flags = ["-fopenmp"]
+
 setup(
   name = 'monotonic_align',
-  ext_modules = cythonize("core.pyx"),
+  ext_modules = cythonize(Extension(
+    "monotonic_align.core", ["core.pyx"],
+    extra_compile_args=openmp_flags,
+    extra_link_args=openmp_flags if sys.platform != "win32" else [])),
   include_dirs=[numpy.get_include()]
 )
@@ -0,0 +1,207 @@
+""" Offline feature extraction.
+
+  python preprocess.py mels -c configs/base.json -o mel_store -f filelists/train.txt filelists/val.txt
+  python preprocess.py tokens -c configs/base.json -o token_store -f filelists/train.txt filelists/val.txt
+  python preprocess.py audio -o audio_archive -f filelists/train.txt filelists/val.txt
+  python preprocess.py shards -c configs/base.json -o train_shards -f filelists/train.txt
+  python preprocess.py lengths -c configs/base.json -f filelists/train.txt filelists/val.txt
+  python preprocess.py update -c configs/base.json -f filelists/*.txt --mel_store mel_store --token_store token_store -j 8
+  python preprocess.py durations -c configs/base.json -m logs/base -o duration_store -f filelists/train.txt
+
+then set "load_mel_from_disk": true and "mel_store_path": "mel_store",
+"token_store_path": "token_store" or "audio_archive_path": "audio_archive" in the data config.
+Sample shards are streamed instead of the training filelist with "training_shards": "train_shards".
+`lengths` (re)builds the WAV header index next to each filelist and prints its statistics.
+`update` brings existing stores up to date with new or changed filelists and audio,
+recomputing only what changed; an interrupted update resumes where it stopped.
+`durations` exports the hard alignments (frames per token) of the latest checkpoint in a
+model directory, keyed by audio path like the other stores.
+"""
+import argparse
+import logging
+import time
+
+import numpy as np
+import torch
+
+import utils
+import models
+import commons
+import feature_store
+from data_utils import TextMelLoader, TextMelCollate
+from text.symbols import symbols
+
+
+def mels(args, hps):
+  start = time.time()
+  n = feature_store.build_mel_store(args.filelists, args.out_dir, hps.data,
+      max_shard_bytes=args.max_shard_mb << 20)
+  logging.info("Stored mels of {} utterances in {} ({:.1f}s)".format(n, args.out_dir, time.time() - start))
+
+
+def tokens(args, hps):
+  start = time.time()
+  n = feature_store.build_token_store(args.filelists, args.out_dir, hps.data,
+      max_shard_bytes=args.max_shard_mb << 20)
+  logging.info("Stored token ids of {} transcripts in {} ({:.1f}s)".format(n, args.out_dir, time.time() - start))
+
+
+def audio(args, hps):
+  start = time.time()
+  n = feature_store.build_audio_archive(args.filelists, args.out_dir,
+      max_shard_bytes=args.max_shard_mb << 20)
+  logging.info("Packed audio of {} utterances in {} ({:.1f}s)".format(n, args.out_dir, time.time() - start))
+
+
+def shards(args, hps):
+  start = time.time()
+  n = feature_store.build_sample_shards(args.filelists, args.out_dir, hps.data,
+      features=args.features, samples_per_shard=args.samples_per_shard)
+  logging.info("Wrote {} samples to shards in {} ({:.1f}s)".format(n, args.out_dir, time.time() - start))
+
+
+def lengths(args, hps):
+  for filelist in args.filelists:
+    start = time.time()
+    sampling_rates, num_samples = utils.load_wav_lengths(filelist)
+    seconds = num_samples / sampling_rates
+    frames = num_samples // hps.data.hop_length + 1
+    logging.info("{}: {} utterances, {:.2f} hours ({:.1f}s)".format(
+        filelist, len(num_samples), seconds.sum() / 3600, time.time() - start))
+    logging.info("  seconds min {:.2f} median {:.2f} max {:.2f}, frames min {} median {} max {}".format(
+        seconds.min(), np.median(seconds), seconds.max(), frames.min(), int(np.median(frames)), frames.max()))
+    mismatched = np.count_nonzero(sampling_rates != hps.data.sampling_rate)
+    if mismatched > 0:
+      logging.warning("  {} files don't match the target {} SR".format(mismatched, hps.data.sampling_rate))
+
+
+def update(args, hps):
+  start = time.time()
+  if args.mel_store is not None:
+    n, total = feature_store.update_mel_store(args.filelists, args.mel_store, hps.data,
+        num_workers=args.num_workers, chunk_size=args.chunk_size, max_shard_bytes=args.max_shard_mb << 20)
+    logging.info("Computed {} of {} mels in {} ({:.1f}s)".format(n, total, args.mel_store, time.time() - start))
+  if args.token_store is not None:
+    n, total = feature_store.update_token_store(args.filelists, args.token_store, hps.data,
+        max_shard_bytes=args.max_shard_mb << 20)
+    logging.info("Tokenized {} of {} transcripts in {} ({:.1f}s)".format(n, total, args.token_store, time.time() - start))
+  if not hps.data.load_mel_from_disk:
+    for filelist in args.filelists:
+      utils.load_wav_lengths(filelist)
+    logging.info("Updated the length indices ({:.1f}s)".format(time.time() - start))
+
+
+@torch.no_grad()
+def durations(args, hps):
+  start = time.time()
+  device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+  generator = models.FlowGenerator(
+      n_vocab=len(symbols) + getattr(hps.data, "add_blank", False),
+      out_channels=hps.data.n_mel_channels,
+      **hps.model).to(device)
+  checkpoint_path = utils.latest_checkpoint_path(args.model_dir, "G_*.pth")
+  utils.load_checkpoint(checkpoint_path, generator)
+  generator.eval()
+  mel_stft = None
+  if getattr(hps.data, "mel_on_device", False):
+    mel_stft = commons.TacotronSTFT(
+        hps.data.filter_length, hps.data.hop_length, hps.data.win_length,
+        hps.data.n_mel_channels, hps.data.sampling_rate, hps.data.mel_fmin,
+        hps.data.mel_fmax).to(device)
+
+  meta = {"kind": "durations", "checkpoint": checkpoint_path, "hop_length": int(hps.data.hop_length),
+      "n_sqz": int(generator.n_sqz)}
+  n = 0
+  with feature_store.ShardedArrayWriter(args.out_dir, np.int16, (), meta, args.max_shard_mb << 20) as writer:
+    for filelist in args.filelists:
+      dataset = TextMelLoader(filelist, hps.data, return_ids=True)
+      loader = torch.utils.data.DataLoader(dataset, batch_size=args.batch_size, shuffle=False,
+          num_workers=args.num_workers, collate_fn=TextMelCollate(hps.data, return_ids=True))
+      for x, x_lengths, y, y_lengths, ids in loader:
+        x, x_lengths, y, y_lengths = [t.to(device) for t in [x, x_lengths, y, y_lengths]]
+        if mel_stft is not None:
+          y, y_lengths = mel_stft.mel_spectrogram(y, y_lengths), mel_stft.num_frames(y_lengths)
+        _, _, (attn, _, _) = generator(x, x_lengths, y, y_lengths, gen=False)
+        durations = attn.sum(-1).squeeze(1).to(device="cpu", dtype=torch.int16).numpy()
+        for index, d, t_x in zip(ids.tolist(), durations, x_lengths.tolist()):
+          writer.add(dataset.audiopaths_and_text[index][0], d[:t_x])
+          n += 1
+  logging.info("Stored durations of {} utterances in {} ({:.1f}s)".format(n, args.out_dir, time.time() - start))
+
+
+def add_common_arguments(parser):
+  parser.add_argument('-c', '--config', type=str, default="./configs/base.json",
+                      help='JSON file for configuration')
+  parser.add_argument('-f', '--filelists', type=str, nargs='+', required=True,
+                      help='filelists to preprocess')
+  parser.add_argument('-o', '--out_dir', type=str, required=True,
+                      help='output directory of the store')
+  parser.add_argument('--max_shard_mb', type=int, default=1024,
+                      help='maximum size of a single shard')
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  subparsers = parser.add_subparsers(dest="command", required=True)
+
+  parser_mels = subparsers.add_parser("mels", help="build a memory-mapped mel store")
+  add_common_arguments(parser_mels)
+  parser_mels.set_defaults(func=mels)
+
+  parser_tokens = subparsers.add_parser("tokens", help="build a token id store for the configured text frontend")
+  add_common_arguments(parser_tokens)
+  parser_tokens.set_defaults(func=tokens)
+
+  parser_audio = subparsers.add_parser("audio", help="pack all audio into a memory-mapped archive")
+  add_common_arguments(parser_audio)
+  parser_audio.set_defaults(func=audio)
+
+  parser_shards = subparsers.add_parser("shards", help="write tar shards of whole samples for sequential streaming")
+  add_common_arguments(parser_shards)
+  parser_shards.add_argument('--features', type=str, choices=["audio", "mel"], default="audio",
+                      help='store 16-bit audio or precomputed mels')
+  parser_shards.add_argument('--samples_per_shard', type=int, default=1000,
+                      help='number of samples per shard')
+  parser_shards.set_defaults(func=shards)
+
+  parser_lengths = subparsers.add_parser("lengths", help="index utterance lengths from WAV headers")
+  parser_lengths.add_argument('-c', '--config', type=str, default="./configs/base.json",
+                      help='JSON file for configuration')
+  parser_lengths.add_argument('-f', '--filelists', type=str, nargs='+', required=True,
+                      help='filelists to index')
+  parser_lengths.set_defaults(func=lengths)
+
+  parser_update = subparsers.add_parser("update", help="incrementally update stores and length indices")
+  parser_update.add_argument('-c', '--config', type=str, default="./configs/base.json",
+                      help='JSON file for configuration')
+  parser_update.add_argument('-f', '--filelists', type=str, nargs='+', required=True,
+                      help='filelists to preprocess')
+  parser_update.add_argument('--mel_store', type=str, default=None,
+                      help='mel store to update')
+  parser_update.add_argument('--token_store', type=str, default=None,
+                      help='token store to update')
+  parser_update.add_argument('-j', '--num_workers', type=int, default=1,
+                      help='processes computing mels')
+  parser_update.add_argument('--chunk_size', type=int, default=256,
+                      help='mels computed between commits')
+  parser_update.add_argument('--max_shard_mb', type=int, default=1024,
+                      help='maximum size of a single shard')
+  parser_update.set_defaults(func=update)
+
+  parser_durations = subparsers.add_parser("durations", help="export the alignments of a trained model")
+  add_common_arguments(parser_durations)
+  parser_durations.add_argument('-m', '--model_dir', type=str, required=True,
+                      help='model directory with G_*.pth checkpoints')
+  parser_durations.add_argument('-b', '--batch_size', type=int, default=32,
+                      help='utterances aligned at once')
+  parser_durations.add_argument('-j', '--num_workers', type=int, default=1,
+                      help='data loader workers')
+  parser_durations.set_defaults(func=durations)
+
+  args = parser.parse_args()
+  hps = utils.get_hparams_from_file(args.config)
+  args.func(args, hps)
+
+
+if __name__ == "__main__":
+  main()
@@ -11,6 +11,9 @@ _id_to_symbol = {i: s for i, s in enumerate(symbols)}
 # Regular expression matching text enclosed in curly braces:
 _curly_re = re.compile(r'(.*?)\{(.+?)\}(.*)')
 
+# Upper bound on the number of words whose symbol ids are cached per dictionary:
+_max_cached_words = 1 << 20
+
 
 def get_arpabet(word, dictionary):
   word_arpabet = dictionary.lookup(word)
@@ -43,13 +46,8 @@ def text_to_sequence(text, cleaner_names, dictionary=None):
     if not m:
       clean_text = _clean_text(text, cleaner_names)
       if dictionary is not None:
-        clean_text = [get_arpabet(w, dictionary) for w in clean_text.split(" ")]
-        for i in range(len(clean_text)):
-          t = clean_text[i]
-          if t.startswith("{"):
-            sequence += _arpabet_to_sequence(t[1:-1])
-          else:
-            sequence += _symbols_to_sequence(t)
+        for w in clean_text.split(" "):
+          sequence += _word_to_sequence(w, dictionary)
           sequence += space
       else:
         sequence += _symbols_to_sequence(clean_text)
@@ -86,6 +84,23 @@ def _clean_text(text, cleaner_names):
   return text
 
 
+def _word_to_sequence(word, dictionary):
+  '''Symbol ids of get_arpabet(word, dictionary), memoized on the dictionary.'''
+  cache = getattr(dictionary, 'sequence_cache', None)
+  if cache is not None:
+    sequence = cache.get(word)
+    if sequence is not None:
+      return sequence
+  t = get_arpabet(word, dictionary)
+  if t.startswith("{"):
+    sequence = _arpabet_to_sequence(t[1:-1])
+  else:
+    sequence = _symbols_to_sequence(t)
+  if cache is not None and len(cache) < _max_cached_words:
+    cache[word] = sequence
+  return sequence
+
+
 def _symbols_to_sequence(symbols):
   return [_symbol_to_id[s] for s in symbols if _should_keep_symbol(s)]
 
@@ -20,8 +20,8 @@ from .numbers import normalize_numbers
 # Regular expression matching whitespace:
 _whitespace_re = re.compile(r'\s+')
 
-# List of (regular expression, replacement) pairs for abbreviations:
-_abbreviations = [(re.compile('\\b%s\\.' % x[0], re.IGNORECASE), x[1]) for x in [
+# List of (abbreviation, replacement) pairs, in the order they are expanded:
+_abbreviation_list = [
   ('mrs', 'misess'),
   ('mr', 'mister'),
   ('dr', 'doctor'),
@@ -40,7 +40,14 @@ _abbreviations = [(re.compile('\\b%s\\.' % x[0], re.IGNORECASE), x[1]) for x in
   ('ltd', 'limited'),
   ('col', 'colonel'),
   ('ft', 'fort'),
-]]
+]
+
+# List of (regular expression, replacement) pairs for abbreviations:
+_abbreviations = [(re.compile('\\b%s\\.' % x[0], re.IGNORECASE), x[1]) for x in _abbreviation_list]
+
+# All abbreviations as one alternation, and abbreviation -> (expansion order, replacement):
+_abbreviation_re = re.compile('\\b(%s)\\.' % '|'.join(x[0] for x in _abbreviation_list), re.IGNORECASE)
+_abbreviation_lookup = {x[0]: (i, x[1]) for i, x in enumerate(_abbreviation_list)}
 
 
 def expand_abbreviations(text):
@@ -49,6 +56,31 @@ def expand_abbreviations(text):
   return text
 
 
+def expand_abbreviations_single_pass(text):
+  '''Same output as expand_abbreviations, in a single scan over the text.
+
+  The sequential version can only differ where an abbreviation directly follows one that was
+  expanded before it, e.g. "mr.co.": "mr." becomes "mister" first, which removes the word
+  boundary in front of "co.", so "co." is left as it is. Such matches are skipped here too.
+  '''
+  pieces = []
+  end = 0
+  prev_order = None
+  for m in _abbreviation_re.finditer(text):
+    order, replacement = _abbreviation_lookup[m.group(1).lower()]
+    if m.start() == end and prev_order is not None and prev_order < order:
+      prev_order = None
+      continue
+    pieces.append(text[end:m.start()])
+    pieces.append(replacement)
+    end = m.end()
+    prev_order = order
+  if not pieces:
+    return text
+  pieces.append(text[end:])
+  return ''.join(pieces)
+
+
 def expand_numbers(text):
   return normalize_numbers(text)
 
@@ -58,7 +90,7 @@ def lowercase(text):
 
 
 def collapse_whitespace(text):
-  return re.sub(_whitespace_re, ' ', text)
+  return _whitespace_re.sub(' ', text)
 
 
 def convert_to_ascii(text):
@@ -85,6 +117,6 @@ def english_cleaners(text):
   text = convert_to_ascii(text)
   text = lowercase(text)
   text = expand_numbers(text)
-  text = expand_abbreviations(text)
+  text = expand_abbreviations_single_pass(text)
   text = collapse_whitespace(text)
   return text
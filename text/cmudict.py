@@ -1,6 +1,8 @@
 """ from https://github.com/keithito/tacotron """
 
+import os
 import re
+import numpy as np
 
 
 valid_symbols = [
@@ -15,18 +17,23 @@ valid_symbols = [
 
 _valid_symbol_set = set(valid_symbols)
 
+# Parsed dictionaries are cached next to their source file:
+_cache_suffix = '.cache.npz'
+_cache_version = 1
+
 
 class CMUDict:
   '''Thin wrapper around CMUDict data. http://www.speech.cs.cmu.edu/cgi-bin/cmudict'''
   def __init__(self, file_or_path, keep_ambiguous=True):
     if isinstance(file_or_path, str):
-      with open(file_or_path, encoding='latin-1') as f:
-        entries = _parse_cmudict(f)
+      entries = _load_cmudict(file_or_path)
     else:
-      entries = _parse_cmudict(file_or_path)
+      entries = _PronunciationTable.from_dict(_parse_cmudict(file_or_path))
     if not keep_ambiguous:
-      entries = {word: pron for word, pron in entries.items() if len(pron) == 1}
+      entries = entries.unambiguous()
     self._entries = entries
+    # word -> symbol ids, filled by text._word_to_sequence
+    self.sequence_cache = {}
 
 
   def __len__(self):
@@ -42,6 +49,69 @@ class CMUDict:
 _alt_re = re.compile(r'\([0-9]+\)')
 
 
+class _PronunciationTable:
+  '''Read-only word -> pronunciations map over sorted arrays, which load without building
+  a Python object per entry.'''
+  def __init__(self, words, pron_offsets, prons):
+    self.words = words                # sorted bytes array
+    self.pron_offsets = pron_offsets  # pronunciations of words[i] are prons[pron_offsets[i]:pron_offsets[i + 1]]
+    self.prons = prons                # tab-separated pronunciations, latin-1 bytes
+
+  @classmethod
+  def from_dict(cls, entries):
+    words = sorted(entries)
+    prons = [('\t'.join(entries[w])).encode('latin-1') for w in words]
+    pron_offsets = np.zeros(len(words) + 1, dtype=np.int64)
+    np.cumsum([len(p) for p in prons], out=pron_offsets[1:])
+    return cls(np.array([w.encode('latin-1') for w in words], dtype=np.bytes_), pron_offsets, b''.join(prons))
+
+  def unambiguous(self):
+    keep = [i for i in range(len(self)) if b'\t' not in self._prons_at(i)]
+    return _PronunciationTable.from_dict({self.words[i].decode('latin-1'): [self._prons_at(i).decode('latin-1')] for i in keep})
+
+  def __len__(self):
+    return len(self.words)
+
+  def _prons_at(self, i):
+    return self.prons[self.pron_offsets[i]:self.pron_offsets[i + 1]]
+
+  def get(self, word):
+    try:
+      key = word.encode('latin-1')
+    except UnicodeEncodeError:
+      return None
+    if len(key) > self.words.itemsize:
+      return None
+    i = int(np.searchsorted(self.words, key))
+    if i == len(self.words) or self.words[i] != key:
+      return None
+    return self._prons_at(i).decode('latin-1').split('\t')
+
+
+def _load_cmudict(path):
+  '''Parses the dictionary at `path`, or loads it from a cache built from the same file.'''
+  stat = os.stat(path)
+  stamp = np.array([_cache_version, stat.st_mtime_ns, stat.st_size], dtype=np.int64)
+  cache_path = path + _cache_suffix
+  try:
+    with np.load(cache_path) as cache:
+      if np.array_equal(cache['stamp'], stamp):
+        return _PronunciationTable(cache['words'], cache['pron_offsets'], cache['prons'].tobytes())
+  except Exception:
+    pass  # missing, stale or unreadable cache
+
+  with open(path, encoding='latin-1') as f:
+    entries = _PronunciationTable.from_dict(_parse_cmudict(f))
+  try:
+    tmp_path = '%s.%d.tmp.npz' % (path, os.getpid())
+    np.savez(tmp_path, stamp=stamp, words=entries.words, pron_offsets=entries.pron_offsets,
+      prons=np.frombuffer(entries.prons, dtype=np.uint8))
+    os.replace(tmp_path, cache_path)
+  except OSError:
+    pass  # read-only location, parse again next time
+  return entries
+
+
 def _parse_cmudict(file):
   cmudict = {}
   for line in file:
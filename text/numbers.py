@@ -2,6 +2,7 @@
 
 import inflect
 import re
+from functools import lru_cache
 
 
 _inflect = inflect.engine()
@@ -11,6 +12,7 @@ _pounds_re = re.compile(r'£([0-9\,]*[0-9]+)')
 _dollars_re = re.compile(r'\$([0-9\.\,]*[0-9]+)')
 _ordinal_re = re.compile(r'[0-9]+(st|nd|rd|th)')
 _number_re = re.compile(r'[0-9]+')
+_digit_re = re.compile(r'[0-9]')
 
 
 def _remove_commas(m):
@@ -42,12 +44,23 @@ def _expand_dollars(m):
     return 'zero dollars'
 
 
+# inflect is slow and the same numbers keep coming back, so their expansions are memoized
+@lru_cache(maxsize=65536)
+def _ordinal_to_words(ordinal):
+  return _inflect.number_to_words(ordinal)
+
+
 def _expand_ordinal(m):
-  return _inflect.number_to_words(m.group(0))
+  return _ordinal_to_words(m.group(0))
 
 
 def _expand_number(m):
-  num = int(m.group(0))
+  return _number_to_words(m.group(0))
+
+
+@lru_cache(maxsize=65536)
+def _number_to_words(number):
+  num = int(number)
   if num > 1000 and num < 3000:
     if num == 2000:
       return 'two thousand'
@@ -62,6 +75,8 @@ def _expand_number(m):
 
 
 def normalize_numbers(text):
+  if _digit_re.search(text) is None:
+    return text  # every pattern below needs a digit
   text = re.sub(_comma_number_re, _remove_commas, text)
   text = re.sub(_pounds_re, r'\1 pounds', text)
   text = re.sub(_dollars_re, _expand_dollars, text)
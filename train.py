@@ -14,7 +14,7 @@ import torch.distributed as dist
 from apex.parallel import DistributedDataParallel as DDP
 from apex import amp
 
-from data_utils import TextMelLoader, TextMelCollate
+from data_utils import TextMelLoader, TextMelShardDataset, TextMelCollate, DistributedBucketSampler, loader_worker_kwargs
 import models
 import commons
 import utils
@@ -22,7 +22,7 @@ from text.symbols import symbols
 from audio_aug.augment import Augmentor
 
 global_step = 0
-NUM_CPUS = 1 #  mp.cpu_count()
+NUM_CPUS = 1 # default for hps.train.num_workers
 
 
 def main(hps, augmentor, run_num):
@@ -52,24 +52,75 @@ def train_and_eval(rank, n_gpus, hps, augmentor):
   torch.manual_seed(hps.train.seed)
   torch.cuda.set_device(rank)
 
-  train_dataset = TextMelLoader(hps.data.training_files, hps.data)
-  train_sampler = torch.utils.data.distributed.DistributedSampler(
-      train_dataset,
-      num_replicas=n_gpus,
-      rank=rank,
-      shuffle=True)
+  worker_kwargs = loader_worker_kwargs(hps.train, NUM_CPUS)
+  # durations are cached by dataset index, which sequential shards do not have
+  duration_cache = None
+  if getattr(hps.train, "duration_cache_epochs", 0) > 0 and getattr(hps.data, "training_shards", None) is None:
+    duration_cache = utils.DurationCache(hps.train.duration_cache_epochs,
+        getattr(hps.train, "duration_cache_loss_drift", 0.))
   train_collate_fn = TextMelCollate(hparams=hps.data, n_frames_per_step=1,
-                                    augmentor=augmentor)
+                                    augmentor=augmentor, return_ids=duration_cache is not None)
   val_collate_fn = TextMelCollate(hparams=hps.data, n_frames_per_step=1)
-  train_loader = DataLoader(train_dataset, num_workers=NUM_CPUS, shuffle=False,
-      batch_size=hps.train.batch_size, pin_memory=True,
-      drop_last=True, collate_fn=train_collate_fn, sampler=train_sampler)
+  # only batches that really get augmented need the signals next to the mels; mel_on_device is
+  # rejected (by the collate) only then
+  augment = train_collate_fn.augmentor is not None
+  max_frames = getattr(hps.train, "max_frames", None)
+  if getattr(hps.data, "training_shards", None) is not None:
+    # sequential streaming from tar shards instead of random access to the filelist
+    train_dataset = TextMelShardDataset(
+        hps.data.training_shards,
+        hps.data,
+        rank=rank,
+        num_replicas=n_gpus,
+        num_workers=worker_kwargs["num_workers"],
+        batch_size=hps.train.batch_size,
+        shuffle_buffer=getattr(hps.train, "shuffle_buffer", 256),
+        seed=hps.train.seed,
+        return_signal=augment)
+    train_sampler = None
+    train_loader = DataLoader(train_dataset, **worker_kwargs,
+        batch_size=hps.train.batch_size, pin_memory=True,
+        collate_fn=train_collate_fn)
+  elif getattr(hps.train, "boundaries", None) is not None or max_frames is not None:
+    # mels are computed per item in the workers, only augmentation needs the signals
+    train_dataset = TextMelLoader(hps.data.training_files, hps.data, return_signal=augment,
+        return_ids=duration_cache is not None)
+    # batches of similar mel lengths, optionally sized by a frame budget
+    train_sampler = DistributedBucketSampler(
+        train_dataset,
+        hps.train.batch_size,
+        getattr(hps.train, "boundaries", None) or [0, float("inf")],
+        num_replicas=n_gpus,
+        rank=rank,
+        shuffle=True,
+        max_frames=max_frames,
+        frame_budget=getattr(hps.train, "frame_budget", "max"))
+    train_loader = DataLoader(train_dataset, shuffle=False, **worker_kwargs,
+        pin_memory=True, collate_fn=train_collate_fn, batch_sampler=train_sampler)
+  else:
+    train_dataset = TextMelLoader(hps.data.training_files, hps.data, return_signal=augment,
+        return_ids=duration_cache is not None)
+    train_sampler = torch.utils.data.distributed.DistributedSampler(
+        train_dataset,
+        num_replicas=n_gpus,
+        rank=rank,
+        shuffle=True)
+    train_loader = DataLoader(train_dataset, shuffle=False, **worker_kwargs,
+        batch_size=hps.train.batch_size, pin_memory=True,
+        drop_last=True, collate_fn=train_collate_fn, sampler=train_sampler)
   if rank == 0:
     val_dataset = TextMelLoader(hps.data.validation_files, hps.data)
-    val_loader = DataLoader(val_dataset, num_workers=NUM_CPUS, shuffle=False,
+    val_loader = DataLoader(val_dataset, shuffle=False, **worker_kwargs,
         batch_size=hps.train.batch_size, pin_memory=True,
         drop_last=True, collate_fn=val_collate_fn)
 
+  mel_stft = None
+  if getattr(hps.data, "mel_on_device", False):
+    mel_stft = commons.TacotronSTFT(
+        hps.data.filter_length, hps.data.hop_length, hps.data.win_length,
+        hps.data.n_mel_channels, hps.data.sampling_rate, hps.data.mel_fmin,
+        hps.data.mel_fmax).cuda(rank)
+
   generator = models.FlowGenerator(
       n_vocab=len(symbols) + getattr(hps.data, "add_blank", False),
       out_channels=hps.data.n_mel_channels,
@@ -83,7 +134,10 @@ def train_and_eval(rank, n_gpus, hps, augmentor):
   try:
     _, _, _, epoch_str = utils.load_checkpoint(utils.latest_checkpoint_path(hps.model_dir, "G_*.pth"), generator, optimizer_g)
     epoch_str += 1
-    optimizer_g.step_num = (epoch_str - 1) * len(train_loader)
+    if isinstance(train_sampler, DistributedBucketSampler):
+      optimizer_g.step_num = (epoch_str - 1) * train_sampler.reference_steps_per_epoch()
+    else:
+      optimizer_g.step_num = (epoch_str - 1) * len(train_loader)
     optimizer_g._update_learning_rate()
     global_step = (epoch_str - 1) * len(train_loader)
   except:
@@ -92,34 +146,63 @@ def train_and_eval(rank, n_gpus, hps, augmentor):
 
   for epoch in range(epoch_str, hps.train.epochs + 1):
     if rank==0:
-      train_loss = train(rank, epoch, hps, generator, optimizer_g, train_loader, logger, writer)
-      eval_loss = evaluate(rank, epoch, hps, generator, optimizer_g, val_loader, logger, writer_eval)
+      train_loss = train(rank, epoch, hps, generator, optimizer_g, train_loader, logger, writer, mel_stft, duration_cache)
+      eval_loss = evaluate(rank, epoch, hps, generator, optimizer_g, val_loader, logger, writer_eval, mel_stft)
       wandb.log({"val_loss": eval_loss, "train_loss": train_loss}, step=epoch)
       utils.save_checkpoint(generator, optimizer_g, hps.train.learning_rate, epoch, os.path.join(hps.model_dir, "G_{}.pth".format(epoch)))
     else:
-      train(rank, epoch, hps, generator, optimizer_g, train_loader, None, None)
+      train(rank, epoch, hps, generator, optimizer_g, train_loader, None, None, mel_stft, duration_cache)
   wandb.join()
 
 
-def train(rank, epoch, hps, generator, optimizer_g, train_loader, logger, writer):
-  train_loader.sampler.set_epoch(epoch)
+def train(rank, epoch, hps, generator, optimizer_g, train_loader, logger, writer, mel_stft=None, duration_cache=None):
+  if isinstance(train_loader.batch_sampler, DistributedBucketSampler):
+    train_loader.batch_sampler.set_epoch(epoch)
+  elif isinstance(train_loader.dataset, TextMelShardDataset):
+    train_loader.dataset.set_epoch(epoch)
+  else:
+    train_loader.sampler.set_epoch(epoch)
   global global_step
 
   final_loss = 0
+  loss_sum, n_searched = 0., 0
+  if duration_cache is not None:
+    duration_cache.start_epoch(epoch)
   generator.train()
-  for batch_idx, (x, x_lengths, y, y_lengths) in enumerate(train_loader):
+  for batch_idx, (x, x_lengths, y, y_lengths, *ids) in enumerate(train_loader):
+    durations = prev_durations = None
+    if duration_cache is not None:
+      # cached durations of the whole batch skip the alignment search, except when refreshing
+      # them, where they only narrow the search band
+      n_frames = mel_stft.num_frames(y_lengths) if mel_stft is not None else y_lengths
+      n_sqz = generator.module.n_sqz
+      cached = duration_cache.lookup(ids[0], x_lengths, (n_frames // n_sqz) * n_sqz)
+      if duration_cache.searching:
+        prev_durations = cached
+      else:
+        durations = cached
+      durations, prev_durations = [d if d is None else d.cuda(rank, non_blocking=True) for d in [durations, prev_durations]]
     x, x_lengths = x.cuda(rank, non_blocking=True), x_lengths.cuda(rank, non_blocking=True)
     y, y_lengths = y.cuda(rank, non_blocking=True), y_lengths.cuda(rank, non_blocking=True)
+    if mel_stft is not None:
+      # the loader ships padded signals, the whole batch is transformed here
+      y, y_lengths = mel_stft.mel_spectrogram(y, y_lengths), mel_stft.num_frames(y_lengths)
 
     # Train Generator
     optimizer_g.zero_grad()
 
-    (z, z_m, z_logs, logdet, z_mask), (x_m, x_logs, x_mask), (attn, logw, logw_) = generator(x, x_lengths, y, y_lengths, gen=False)
+    (z, z_m, z_logs, logdet, z_mask), (x_m, x_logs, x_mask), (attn, logw, logw_) = generator(x, x_lengths, y, y_lengths, gen=False,
+        prev_durations=prev_durations, durations=durations, return_attn=rank == 0 and batch_idx % hps.train.log_interval == 0)
+    if duration_cache is not None and durations is None:
+      duration_cache.update(ids[0], attn.sum(-1).squeeze(1), x_lengths)
+      n_searched += 1
     l_mle = commons.mle_loss(z, z_m, z_logs, logdet, z_mask)
     l_length = commons.duration_loss(logw, logw_, x_lengths)
 
     loss_gs = [l_mle, l_length]
     loss_g = sum(loss_gs)
+    if duration_cache is not None:
+      loss_sum += loss_g.item()
 
     if hps.train.fp16_run:
       with amp.scale_loss(loss_g, optimizer_g._optim) as scaled_loss:
@@ -128,7 +211,11 @@ def train(rank, epoch, hps, generator, optimizer_g, train_loader, logger, writer
     else:
       loss_g.backward()
       grad_norm = commons.clip_grad_value_(generator.parameters(), 5)
-    optimizer_g.step()
+    if isinstance(train_loader.batch_sampler, DistributedBucketSampler):
+      # variable-size batches advance the noam schedule by their size
+      optimizer_g.step(train_loader.batch_sampler.step_scale(batch_idx))
+    else:
+      optimizer_g.step()
     
     if rank==0:
       if batch_idx % hps.train.log_interval == 0:
@@ -152,12 +239,25 @@ def train(rank, epoch, hps, generator, optimizer_g, train_loader, logger, writer
     global_step += 1
     final_loss = loss_g.item()
 
+  if duration_cache is not None:
+    # mean loss over all ranks, every rank takes the same refresh decision
+    mean_loss = torch.tensor([loss_sum, len(train_loader)], dtype=torch.float64, device="cuda:{}".format(rank))
+    dist.all_reduce(mean_loss)
+    duration_cache.end_epoch((mean_loss[0] / mean_loss[1]).item())
+    if rank == 0:
+      logger.info('alignment searched in {}/{} steps, durations of {} items cached'.format(
+        n_searched, len(train_loader), len(duration_cache)))
+
   if rank == 0:
     logger.info('====> Epoch: {}'.format(epoch))
+    for name in ["feature_cache", "audio_cache"]:
+      cache = getattr(train_loader.dataset, name, None)
+      if cache is not None:
+        logger.info('{} (all runs on this node): {}'.format(name, cache.stats()))
 
   return final_loss
  
-def evaluate(rank, epoch, hps, generator, optimizer_g, val_loader, logger, writer_eval):
+def evaluate(rank, epoch, hps, generator, optimizer_g, val_loader, logger, writer_eval, mel_stft=None):
   if rank == 0:
     global global_step
     generator.eval()
@@ -167,6 +267,8 @@ def evaluate(rank, epoch, hps, generator, optimizer_g, val_loader, logger, write
       for batch_idx, (x, x_lengths, y, y_lengths) in enumerate(val_loader):
         x, x_lengths = x.cuda(rank, non_blocking=True), x_lengths.cuda(rank, non_blocking=True)
         y, y_lengths = y.cuda(rank, non_blocking=True), y_lengths.cuda(rank, non_blocking=True)
+        if mel_stft is not None:
+          y, y_lengths = mel_stft.mel_spectrogram(y, y_lengths), mel_stft.num_frames(y_lengths)
 
         
         (z, z_m, z_logs, logdet, z_mask), (x_m, x_logs, x_mask), (attn, logw, logw_) = generator(x, x_lengths, y, y_lengths, gen=False)
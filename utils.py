@@ -4,6 +4,8 @@ import sys
 import argparse
 import logging
 import json
+import random
+import struct
 import subprocess
 import numpy as np
 from scipy.io.wavfile import read
@@ -135,12 +137,176 @@ def load_wav_to_torch(full_path):
   return torch.FloatTensor(data.astype(np.float32)), sampling_rate
 
 
+def read_wav_header(full_path):
+  """Returns (sampling_rate, num_samples) of a WAV file, reading only its header."""
+  with open(full_path, 'rb') as f:
+    riff = f.read(12)
+    if len(riff) < 12 or riff[:4] not in (b'RIFF', b'RIFX') or riff[8:12] != b'WAVE':
+      raise ValueError("{} is not a WAV file".format(full_path))
+    endian = '<' if riff[:4] == b'RIFF' else '>'
+    sampling_rate = block_align = None
+    while True:
+      header = f.read(8)
+      if len(header) < 8:
+        raise ValueError("{} has no data chunk".format(full_path))
+      chunk_id, size = header[:4], struct.unpack(endian + 'I', header[4:])[0]
+      if chunk_id == b'data':
+        if block_align is None:
+          raise ValueError("{} has no fmt chunk before its data".format(full_path))
+        # the size of streamed files can be a placeholder, trust the file size instead
+        size = min(size, os.fstat(f.fileno()).st_size - f.tell())
+        return sampling_rate, size // block_align
+      if chunk_id == b'fmt ':
+        _, _, sampling_rate, _, block_align = struct.unpack(endian + 'HHIIH', f.read(14))
+        f.seek(size - 14 + size % 2, 1)
+      else:
+        f.seek(size + size % 2, 1)
+
+
+def load_wav_lengths(filelist, split="|"):
+  """Sampling rates and sample counts of the audio in `filelist` (in filelist order), read
+  from the WAV headers only. Cached in <filelist>.lengths.npz until the filelist changes.
+  """
+  stat = os.stat(filelist)
+  stamp = np.array([stat.st_mtime_ns, stat.st_size], dtype=np.int64)
+  cache_path = filelist + ".lengths.npz"
+  try:
+    with np.load(cache_path) as cache:
+      if np.array_equal(cache["stamp"], stamp):
+        return cache["sampling_rates"], cache["num_samples"]
+  except Exception:
+    pass  # missing, stale or unreadable cache
+
+  headers = [read_wav_header(x[0]) for x in load_filepaths_and_text(filelist, split)]
+  sampling_rates = np.array([x[0] for x in headers], dtype=np.int64).reshape(-1)
+  num_samples = np.array([x[1] for x in headers], dtype=np.int64).reshape(-1)
+  try:
+    tmp_path = "{}.{}.tmp.npz".format(filelist, os.getpid())
+    np.savez(tmp_path, stamp=stamp, sampling_rates=sampling_rates, num_samples=num_samples)
+    os.replace(tmp_path, cache_path)
+  except OSError:
+    pass  # read-only location, read the headers again next time
+  return sampling_rates, num_samples
+
+
 def load_filepaths_and_text(filename, split="|"):
   with open(filename, encoding='utf-8') as f:
     filepaths_and_text = [line.strip().split(split) for line in f]
   return filepaths_and_text
 
 
+class PackedFilelist():
+  """Filelist rows kept as one utf-8 blob plus offsets per column, in numpy arrays.
+
+  Unlike a list of lists of strings, forked DataLoader workers can read it without touching
+  (and so copying) any per-row Python object. Rows are decoded on access.
+  """
+  def __init__(self, rows):
+    n_columns = len(rows[0]) if len(rows) > 0 else 0
+    self.blobs, self.offsets = [], []
+    for c in range(n_columns):
+      encoded = [row[c].encode('utf-8') for row in rows]
+      offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+      np.cumsum([len(x) for x in encoded], out=offsets[1:])
+      self.blobs.append(np.frombuffer(b''.join(encoded), dtype=np.uint8))
+      self.offsets.append(offsets)
+    self.order = np.arange(len(rows), dtype=np.int64)
+
+  def __len__(self):
+    return len(self.order)
+
+  def __getitem__(self, index):
+    i = self.order[index]
+    return [blob[offsets[i]:offsets[i + 1]].tobytes().decode('utf-8')
+            for blob, offsets in zip(self.blobs, self.offsets)]
+
+  def __iter__(self):
+    for index in range(len(self)):
+      yield self[index]
+
+  def shuffle(self, rng=random):
+    """Same permutation as rng.shuffle on the list of rows."""
+    order = self.order.tolist()
+    rng.shuffle(order)
+    self.order = np.array(order, dtype=np.int64)
+
+
+def load_packed_filepaths_and_text(filename, split="|"):
+  rows = load_filepaths_and_text(filename, split)
+  if len(set(len(row) for row in rows)) > 1:
+    raise ValueError("{} has rows with different numbers of fields".format(filename))
+  return PackedFilelist(rows)
+
+
+class DurationCache():
+  """Hard alignments (frame durations per token) found by the alignment search, by dataset
+  index, so that most training steps can skip the search (see FlowGenerator durations).
+
+  Alignments are searched again for a whole epoch every `refresh_epochs` epochs, and after
+  an epoch whose mean loss rose more than `loss_drift` above the loss of the last searching
+  epoch (0 to only refresh on schedule). Batches with an item that has no (or a stale)
+  duration are searched as well.
+  """
+  def __init__(self, refresh_epochs, loss_drift=0.):
+    self.refresh_epochs = refresh_epochs
+    self.loss_drift = loss_drift
+    self.durations = {}
+    self._updates = {}
+    self.searching = True
+    self._last_search_epoch = None
+    self._reference_loss = None
+    self._drifted = False
+
+  def __len__(self):
+    return len(self.durations)
+
+  def start_epoch(self, epoch):
+    """Decides whether `epoch` searches all alignments; returns self.searching"""
+    self.searching = (self._last_search_epoch is None or self._drifted
+        or epoch - self._last_search_epoch >= self.refresh_epochs)
+    if self.searching:
+      self._last_search_epoch = epoch
+      self._drifted = False
+    return self.searching
+
+  def lookup(self, ids, x_lengths, y_lengths):
+    """[b, t_x] float durations of a batch, or None unless all of its items have durations of
+    x_lengths tokens summing to y_lengths frames (y_lengths as the model rounds them).
+    """
+    ids, x_lengths, y_lengths = ids.tolist(), x_lengths.tolist(), y_lengths.tolist()
+    durations = torch.zeros(len(ids), max(x_lengths))
+    for i, (index, t_x, t_y) in enumerate(zip(ids, x_lengths, y_lengths)):
+      d = self.durations.get(index)
+      if d is None or len(d) != t_x or int(d.sum()) != t_y:
+        return None
+      durations[i, :t_x] = torch.from_numpy(d)
+    return durations
+
+  def update(self, ids, durations, x_lengths):
+    """durations: [b, t_x] (attn.sum(-1)), stored for items with an index >= 0"""
+    durations = durations.detach().to(device="cpu", dtype=torch.int16).numpy()
+    for index, d, t_x in zip(ids.tolist(), durations, x_lengths.tolist()):
+      if index >= 0:
+        self._updates[index] = d[:t_x].copy()
+
+  def end_epoch(self, loss):
+    """Shares the durations found this epoch with all ranks and checks `loss`, the mean
+    training loss of the epoch (the same on all ranks)
+    """
+    updates = [self._updates]
+    if torch.distributed.is_available() and torch.distributed.is_initialized():
+      updates = [None] * torch.distributed.get_world_size()
+      torch.distributed.all_gather_object(updates, self._updates)
+    for u in updates:
+      self.durations.update(u)
+    self._updates = {}
+
+    if self.searching:
+      self._reference_loss = loss
+    elif self.loss_drift > 0 and loss - self._reference_loss > self.loss_drift:
+      self._drifted = True
+
+
 def get_hparams(cmd_args, init=True):
   parser = argparse.ArgumentParser()
   parser.add_argument('-c', '--config', type=str, default="./configs/base.json",